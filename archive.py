@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+
+import orders
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = 90
+# Через сколько часов неоплаченный заказ считается просроченным
+EXPIRE_AFTER_HOURS = 72
+ARCHIVE_BATCH = 5000
+ARCHIVE_INTERVAL = 3600
+ARCHIVED_STATUSES = ('completed', 'expired')
+ORDER_COLUMNS = 'order_id, user_id, uc_amount, price, amount_kop, player_id, status, created_at'
+
+
+# Выборка заказов из живой таблицы и, если нужно, из архива. Условия
+# подставляются в каждую ветвь UNION ALL, поэтому обе читают свои индексы,
+# а ORDER BY над составным запросом сливает уже упорядоченные ветви.
+def union_sql(columns, where, tail, include_archive):
+    condition = f" WHERE {where}" if where else ""
+    sql = f"SELECT {columns} FROM main.orders{condition}"
+    if include_archive:
+        sql += f" UNION ALL SELECT {columns} FROM archive.orders{condition}"
+    return sql + " " + tail
+
+
+# Перенос идёт двумя транзакциями. SQLite в режиме WAL фиксирует подключённые
+# базы по очереди, начиная с main, поэтому удаление в одной транзакции со
+# вставкой могло стать постоянным раньше вставки, и после сбоя заказ терялся.
+# Сначала копия в архив фиксируется отдельно (copy_batch), затем те же заказы
+# удаляются из живой таблицы (drop_archived). Сбой между ними оставляет
+# заказ в обеих таблицах; следующий проход копирует его заново и удаляет.
+def copy_batch(conn, cutoff, batch=ARCHIVE_BATCH):
+    placeholders = ", ".join("?" * len(ARCHIVED_STATUSES))
+    ids = [(row[0],) for row in conn.execute(
+        f"SELECT order_id FROM main.orders WHERE status IN ({placeholders}) AND created_at < ? LIMIT ?",
+        ARCHIVED_STATUSES + (cutoff, batch)
+    )]
+    # Пока заказ есть в живой таблице, она главнее: копия перезаписывается
+    conn.executemany(
+        f"INSERT OR REPLACE INTO archive.orders ({ORDER_COLUMNS}) "
+        f"SELECT {ORDER_COLUMNS} FROM main.orders WHERE order_id = ?",
+        ids
+    )
+    return ids
+
+
+# Удаляются только строки, совпадающие с архивной копией по статусу:
+# заказ, который успели завершить между транзакциями, остаётся живым
+def drop_archived(conn, ids):
+    conn.executemany(
+        "DELETE FROM main.orders WHERE order_id = ? AND status = "
+        "(SELECT a.status FROM archive.orders a WHERE a.order_id = main.orders.order_id)",
+        ids
+    )
+
+
+def archive_counts(conn):
+    live = conn.execute("SELECT COUNT(*) FROM main.orders").fetchone()[0]
+    archived = conn.execute("SELECT COUNT(*) FROM archive.orders").fetchone()[0]
+    return live, archived
+
+
+# Периодическое обслуживание живой таблицы: неоплаченные заказы старше
+# expire_after_hours помечаются просроченными, завершённые и просроченные
+# старше max_age_days переносятся в архив. Каждая пачка — отдельные
+# транзакции писателя, между ними проходят обычные записи. Освободившиеся
+# страницы живой базы переиспользуются новыми заказами, поэтому файл не
+# растёт и VACUUM не нужен; после прохода WAL сбрасывается в основной файл.
+class OrderArchiver:
+    def __init__(self, database, max_age_days=ARCHIVE_AFTER_DAYS, expire_after_hours=EXPIRE_AFTER_HOURS,
+                 interval=ARCHIVE_INTERVAL, batch=ARCHIVE_BATCH):
+        self.db = database
+        self.max_age = max_age_days * 86400
+        self.expire_after = expire_after_hours * 3600
+        self.interval = interval
+        self.batch = batch
+        self.archived = 0
+        self.expired = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Order archiver started (expiry after {self.expire_after // 3600}h, "
+                    f"archive after {self.max_age // 86400} days, every {self.interval}s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def expire_once(self, now=None):
+        cutoff = int(now or time.time()) - self.expire_after
+        total = 0
+        while True:
+            expired = await self.db.write(lambda conn: orders.expire_pending(conn, cutoff, self.batch))
+            total += expired
+            if expired < self.batch:
+                break
+        self.expired += total
+        return total
+
+    # Возвращает (просрочено, перенесено в архив)
+    async def run_once(self, now=None):
+        expired = await self.expire_once(now)
+        cutoff = int(now or time.time()) - self.max_age
+        total = 0
+        while True:
+            ids = await self.db.write(lambda conn: copy_batch(conn, cutoff, self.batch))
+            if ids:
+                await self.db.write(lambda conn: drop_archived(conn, ids))
+            total += len(ids)
+            if len(ids) < self.batch:
+                break
+        if total:
+            await self.db.write(lambda conn: conn.execute("PRAGMA main.wal_checkpoint(PASSIVE)").fetchone())
+        self.archived += total
+        return expired, total
+
+    async def _run(self):
+        while True:
+            try:
+                expired, moved = await self.run_once()
+                if expired or moved:
+                    logger.info(f"Expired {expired} pending orders, archived {moved} orders")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Order archiving failed: {e}")
+            await asyncio.sleep(self.interval)
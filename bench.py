@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+import stats
+from db import db
+from metrics import metrics
+from migrations import migrate
+from profiles import profiles
+
+# Нагрузочный прогон настоящих обработчиков без Telegram: синтетические
+# обновления идут в Application, ответы Bot API подменяются локально.
+# Запуск: python bench.py --users 1000 --orders 50000 --updates 500
+
+logger = logging.getLogger('bench')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+# Запрос к Bot API, который ничего не отправляет, а только записывает вызов
+class FakeRequest(BaseRequest):
+    def __init__(self):
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return 5
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[name] += 1
+        if name == 'getMe':
+            result = BOT_USER
+        elif name.startswith(('send', 'edit')):
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+
+    def _next(self):
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        update_id = self._next()
+        entities = []
+        if text.startswith('/'):
+            entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': self._user(user_id),
+                'text': text,
+                'entities': entities,
+            },
+        }
+
+    def callback(self, user_id, data):
+        update_id = self._next()
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': BOT_USER,
+                    'text': '...',
+                },
+            },
+        }
+
+
+def seed(conn, users, orders_count, first_user=100000):
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, language, bonuses) VALUES (?, ?, 0)",
+        [(first_user + i, random.choice(('ru', 'en'))) for i in range(users)]
+    )
+    packages = [(int(uc), bot.catalog.price_kopecks(uc)) for uc in bot.catalog.packages()]
+    now = int(time.time())
+    rows = []
+    for _ in range(orders_count):
+        uc, kopecks = random.choice(packages)
+        rows.append((first_user + random.randrange(users), uc, f"{kopecks / 100:.2f} ₽", kopecks,
+                     random.choice(('pending', 'completed')), now - random.randrange(90 * 86400)))
+    conn.executemany(
+        "INSERT INTO orders (user_id, uc_amount, price, amount_kop, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    return stats.rebuild_aggregates(conn)
+
+
+# Каждый сценарий возвращает список обновлений для одного пользователя
+def flows(factory, user_id):
+    package = random.choice(bot.catalog.packages())
+    return {
+        'start': [factory.message(user_id, '/start')],
+        'buy_uc': [factory.message(user_id, '/buy_uc')],
+        'package': [factory.callback(user_id, f"{package}uc")],
+        'enter_id': [factory.callback(user_id, 'enter_id'),
+                     factory.message(user_id, str(random.randrange(10 ** 8, 10 ** 10)))],
+        'pay': [factory.callback(user_id, 'pay')],
+        'promo': [factory.message(user_id, '/promo'), factory.message(user_id, 'SUMMER10')],
+        'history': [factory.message(user_id, '/history')],
+        'admin_stats': [factory.callback(bot.ADMIN_ID, 'admin_stats')],
+    }
+
+
+async def run_flow(application, name, batches):
+    async def run_user(updates):
+        for data in updates:
+            update = Update.de_json(data, application.bot)
+            await application.update_processor.process_update(update, application.process_update(update))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(updates) for updates in batches))
+    elapsed = time.perf_counter() - started
+    count = sum(len(updates) for updates in batches)
+    return count, elapsed
+
+
+def report(results, request):
+    print(f"{'flow':<12}{'updates':>9}{'upd/s':>10}")
+    for name, (count, elapsed) in results.items():
+        print(f"{name:<12}{count:>9}{count / elapsed:>10.0f}")
+    print()
+    print(f"{'handler':<18}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for labels, histogram in metrics.summary('bot_handler_seconds'):
+        print(f"{labels['handler']:<18}{histogram.count:>7}{histogram.quantile(0.5) * 1000:>9.2f}"
+              f"{histogram.quantile(0.95) * 1000:>9.2f}{histogram.quantile(0.99) * 1000:>9.2f}")
+    print()
+    print("Bot API calls: " + ", ".join(f"{name}={count}" for name, count in sorted(request.calls.items())))
+    print(f"Profile cache: {profiles.stats()}")
+
+
+async def bench(args):
+    factory = UpdateFactory()
+    request = FakeRequest()
+    application = bot.build_application('1:bench', request=request, get_updates_request=FakeRequest())
+    await application.initialize()
+    seeded = await db.write(lambda conn: seed(conn, args.users, args.orders))
+    print(f"Seeded {args.users} users and {seeded} orders in {db.path}\n")
+
+    user_ids = list(range(100000, 100000 + args.users))
+    results = {}
+    for name in args.flows:
+        batches = [flows(factory, random.choice(user_ids))[name] for _ in range(args.updates)]
+        results[name] = await run_flow(application, name, batches)
+    await application.shutdown()
+    report(results, request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot handlers")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--updates', type=int, default=500, help="updates per flow")
+    parser.add_argument('--flows', nargs='+', default=list(flows(UpdateFactory(), 0)))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Отдельная временная БД вместо рабочей
+        db.close()
+        db.open(os.path.join(tmp, 'bench.db'))
+        db.write_sync(migrate)
+        profiles.clear()
+        asyncio.run(bench(args))
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
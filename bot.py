@@ -1,74 +1,112 @@
 import os
-import sqlite3
 import json
 import re
 import asyncio
 import logging
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+import signal
+import time
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from datetime import datetime, timedelta
+from db import db, writes
+from profiles import profiles
+from catalog import BASIS_POINTS, MAX_CUSTOM_UC, PriceCatalog, apply_discount, format_percent, format_price
+from migrations import SCHEMA_VERSION, current_version, migrate
+import orders
+import stats
+from outbox import outbox
+from reminders import ReminderScheduler, schedule_reminder
+from concurrency import PerUserUpdateProcessor
+from persistence import SqlitePersistence
+import promos as promo_codes
+from promos import promos
+import ledger
+from ledger import BonusCompactor
+import archive
+from archive import OrderArchiver
+import broadcast
+from broadcast import Broadcaster
+import export
+from dedup import RecentUpdateFilter, UpdateDeduplicator
+from screenshots import HASH_BITS, ScreenshotChecker
+from faq import FAQ_PATH, FaqEngine
+from metrics import ErrorCounter, MetricsServer, instrument_application, metrics, observe_db
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DATA_DIR = '/opt/data'
+PRICES_PATH = os.path.join(DATA_DIR, 'prices.json')
+
+# Цены по умолчанию: используются, пока в /opt/data нет своего prices.json
+PRICES = {
+    "60": "90.06 ₽", "325": "450.31 ₽", "660": "900.61 ₽",
+    "1800": "2251.53 ₽", "3850": "4503.05 ₽", "8100": "9006.10 ₽"
+}
+
+catalog = PriceCatalog(PRICES_PATH, defaults=PRICES)
+# Частые вопросы; файл перечитывается при изменении без перезапуска бота
+faq = FaqEngine(os.environ.get('FAQ_PATH', FAQ_PATH))
+
 # Проверка директории /opt/data
-try:
-    if not os.path.exists('/opt/data'):
-        os.makedirs('/opt/data')
-        logger.info("Created directory /opt/data")
-    with open('/opt/data/test_write', 'w') as f:
-        f.write('test')
-    os.remove('/opt/data/test_write')
-    logger.info("Write permissions in /opt/data confirmed")
-except Exception as e:
-    logger.error(f"Cannot access or write to /opt/data: {e}")
-    raise
-
-# Инициализация базы данных SQLite
+def init_data_dir():
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        if not os.access(DATA_DIR, os.W_OK):
+            raise PermissionError(f"{DATA_DIR} is not writable")
+    except Exception as e:
+        logger.error(f"Cannot access or write to {DATA_DIR}: {e}")
+        raise
+
+# Инициализация базы данных SQLite: миграции запускаются только если
+# версия схемы в файле отстаёт от кода
 def init_db():
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS orders
-                     (user_id INTEGER, uc_amount TEXT, price TEXT, player_id TEXT, status TEXT, timestamp TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (user_id INTEGER PRIMARY KEY, language TEXT, bonuses INTEGER, referral_code TEXT, referred_by TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS promos
-                     (code TEXT PRIMARY KEY, discount REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS banned_users
-                     (user_id INTEGER PRIMARY KEY)''')
-        c.execute("INSERT OR IGNORE INTO promos (code, discount) VALUES ('SUMMER10', 0.1)")
-        c.execute("INSERT OR IGNORE INTO promos (code, discount) VALUES ('WELCOME', 0.05)")
-        conn.commit()
-        logger.info("Database initialized successfully at /opt/data/bot.db")
+        db.open()
+        version = db.read_sync(current_version)
+        if version != SCHEMA_VERSION:
+            version = db.write_sync(migrate)
+        logger.info(f"Database initialized successfully at {db.path} (schema version {version})")
     except Exception as e:
         logger.error(f"Database initialization failed: {e}")
         raise
-    finally:
-        conn.close()
-
-init_db()
 
-# Загрузка цен из JSON
-PRICES = {
-    "60": "90.06 ₽", "325": "450.31 ₽", "660": "900.61 ₽",
-    "1800": "2251.53 ₽", "3850": "4503.05 ₽", "8100": "9006.10 ₽"
-}
-try:
-    with open('/opt/data/prices.json', 'w') as f:
-        json.dump(PRICES, f)
-    logger.info("prices.json created successfully at /opt/data/prices.json")
-except Exception as e:
-    logger.error(f"Failed to create prices.json: {e}")
-
-def load_prices():
+# Файл цен создаётся только при первом запуске, цены оператора не трогаем
+def init_prices():
     try:
-        with open('/opt/data/prices.json', 'r') as f:
-            return json.load(f)
+        with open(PRICES_PATH, 'x') as f:
+            json.dump(PRICES, f, ensure_ascii=False)
+        logger.info(f"prices.json created successfully at {PRICES_PATH}")
+    except FileExistsError:
+        pass
     except Exception as e:
-        logger.error(f"Failed to load prices.json: {e}")
-        return PRICES
+        logger.error(f"Failed to create prices.json: {e}")
+
+# Явная инициализация вместо побочных эффектов при импорте
+def init():
+    init_data_dir()
+    init_db()
+    init_prices()
+
+def format_timestamp(created_at):
+    return datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M:%S')
+
+# Состояния диалога: каждое текстовое сообщение обрабатывает ровно один
+# обработчик, выбранный по текущему состоянию пользователя
+STATE_KEY = 'state'
+STATE_IDLE = 'idle'
+STATE_AWAITING_ID = 'awaiting_id'
+STATE_AWAITING_PROMO = 'awaiting_promo'
+STATE_AWAITING_CUSTOM_UC = 'awaiting_custom_uc'
+STATE_AWAITING_BAN = 'awaiting_ban'
+STATE_AWAITING_BROADCAST = 'awaiting_broadcast'
+
+def set_state(context, state):
+    if state == STATE_IDLE:
+        context.user_data.pop(STATE_KEY, None)
+    else:
+        context.user_data[STATE_KEY] = state
 
 # Проверка валидности ID игрока
 def is_valid_player_id(player_id):
@@ -105,15 +143,25 @@ TRANSLATIONS = {
         'payment': "Оплата {uc_amount} UC\nPlayerID: {player_id}",
         'screenshot_received': "Скриншот платежа получен! Мы проверим и зачислим UC в течение 10-30 минут.",
         'promo_prompt': "Введите промокод:",
-        'promo_success': "Промокод применен! Скидка: {discount}%",
+        'promo_success': "Промокод применен! Скидка: {discount}",
         'promo_invalid': "Неверный промокод.",
+        'promo_expired': "Срок действия промокода истёк.",
+        'promo_exhausted': "Промокод больше недоступен: лимит использований исчерпан.",
+        'promo_used': "Вы уже использовали этот промокод.",
+        'promo_not_applied': "Промокод больше не действует, заказ оформлен по полной цене.",
         'history': "Ваши заказы:\n{history}",
+        'history_summary': "Всего заказов: {count}, потрачено: {spent}",
+        'history_empty': "У вас пока нет заказов.",
+        'history_older': "Старые заказы ➡️",
+        'history_newer': "⬅️ Новые заказы",
         'bonuses': "Ваши бонусы: {bonuses} UC",
         'custom_uc': "Введите количество UC для расчета цены:",
-        'custom_result': "{uc_amount} UC = {price} ₽",
+        'custom_result': "{uc_amount} UC = {price}\nВыгоднее всего купить: {packages} (итого {covered} UC)",
+        'custom_invalid': "Введите целое число UC от 1 до {max_uc}.",
         'referral': "Ваша реферальная ссылка: {link}\nПриглашайте друзей и получайте 5% бонусов от их покупок!",
         'reminder': "Вы выбрали {uc_amount} UC, но не завершили заказ. Продолжить?",
-        'banned': "Ваш аккаунт заблокирован."
+        'banned': "Ваш аккаунт заблокирован.",
+        'order_completed': "✅ Заказ №{order_id} на {uc_amount} UC выполнен. Спасибо за покупку!"
     },
     'en': {
         'welcome': "Hello, this is the TopUp UC bot (BETA)\nI'll assist you.\n\n"
@@ -144,82 +192,99 @@ TRANSLATIONS = {
         'payment': "Payment for {uc_amount} UC\nPlayerID: {player_id}",
         'screenshot_received': "Payment screenshot received! We will verify and credit UC within 10-30 minutes.",
         'promo_prompt': "Enter promo code:",
-        'promo_success': "Promo code applied! Discount: {discount}%",
+        'promo_success': "Promo code applied! Discount: {discount}",
         'promo_invalid': "Invalid promo code.",
+        'promo_expired': "This promo code has expired.",
+        'promo_exhausted': "This promo code is no longer available: the usage limit has been reached.",
+        'promo_used': "You have already used this promo code.",
+        'promo_not_applied': "The promo code is no longer valid, the order was placed at full price.",
         'history': "Your orders:\n{history}",
+        'history_summary': "Total orders: {count}, spent: {spent}",
+        'history_empty': "You have no orders yet.",
+        'history_older': "Older orders ➡️",
+        'history_newer': "⬅️ Newer orders",
         'bonuses': "Your bonuses: {bonuses} UC",
         'custom_uc': "Enter the amount of UC to calculate the price:",
-        'custom_result': "{uc_amount} UC = {price} USD",
+        'custom_result': "{uc_amount} UC = {price}\nBest deal: {packages} ({covered} UC in total)",
+        'custom_invalid': "Enter a whole number of UC from 1 to {max_uc}.",
         'referral': "Your referral link: {link}\nInvite friends and get 5% bonuses from their purchases!",
         'reminder': "You selected {uc_amount} UC but didn't complete the order. Continue?",
-        'banned': "Your account is banned."
+        'banned': "Your account is banned.",
+        'order_completed': "✅ Order #{order_id} for {uc_amount} UC is completed. Thank you for your purchase!"
     }
 }
 
 # ID админа
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "123456789"))  # Замени через переменную окружения в Render
+# Интервал дайджеста заказов для админа в секундах (0 — уведомлять сразу,
+# пока очередь админа не переполнена)
+ADMIN_DIGEST_INTERVAL = int(os.environ.get("ADMIN_DIGEST_INTERVAL", "60"))
+# Сколько обновлений обрабатывается одновременно (для разных пользователей)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+# Адрес и порт для метрик в формате Prometheus и проверки готовности /healthz
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+# Через сколько дней завершённые и просроченные заказы переносятся в архив
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", str(archive.ARCHIVE_AFTER_DAYS)))
+# Через сколько часов неоплаченный заказ помечается просроченным
+ORDER_EXPIRE_HOURS = int(os.environ.get("ORDER_EXPIRE_HOURS", str(archive.EXPIRE_AFTER_HOURS)))
+
+async def get_language(user_id):
+    return (await profiles.get(user_id)).language
 
 async def check_ban(update: Update, context):
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT user_id FROM banned_users WHERE user_id = ?", (user_id,))
-        if c.fetchone():
+        profile = await profiles.get(user_id)
+        if profile.banned:
             await update.message.reply_text(TRANSLATIONS['ru']['banned'])
             return True
         return False
     except Exception as e:
         logger.error(f"Check ban failed: {e}")
         return False
-    finally:
-        conn.close()
 
 async def start(update: Update, context):
     if await check_ban(update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO users (user_id, language, bonuses) VALUES (?, 'ru', 0)", (user_id,))
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.commit()
-
+        referred_by = None
         if context.args and context.args[0].startswith('ref'):
-            referred_by = context.args[0].replace('ref', '')
-            c.execute("UPDATE users SET referred_by = ? WHERE user_id = ?", (referred_by, user_id))
-            conn.commit()
+            referred_by = int(context.args[0][3:]) if context.args[0][3:].isdigit() else None
+            if referred_by == user_id:
+                referred_by = None
+
+        def register(conn):
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO users (user_id, language, bonuses) VALUES (?, 'ru', 0)", (user_id,))
+            # Пригласивший закрепляется один раз, повторный /start его не меняет;
+            # несуществующий ID не закрепляется, чтобы бонусы не уходили в никуда
+            if referred_by is not None:
+                c.execute("UPDATE users SET referred_by = ? WHERE user_id = ? AND referred_by IS NULL "
+                          "AND EXISTS (SELECT 1 FROM users WHERE user_id = ?)",
+                          (referred_by, user_id, referred_by))
+            c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
+            lang = c.fetchone()[0]
+            schedule_reminder(conn, user_id)
+            # Вернувшийся пользователь снова получает рассылки
+            c.execute("DELETE FROM unreachable_users WHERE user_id = ?", (user_id,))
+            return lang
 
+        lang = await db.write(register)
+        profiles.invalidate(user_id)
         await update.message.reply_text(TRANSLATIONS[lang]['welcome'])
-        context.job_queue.run_once(reminder, 600, data={'user_id': user_id}, name=str(user_id))
     except Exception as e:
         logger.error(f"Start command failed: {e}")
-    finally:
-        conn.close()
 
 async def buy_uc(update: Update, context):
     if await check_ban(update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
+        lang = await get_language(user_id)
 
-        prices = load_prices()
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"60 UC: {prices['60']}", callback_data="60uc")],
-            [InlineKeyboardButton(f"325 UC: {prices['325']}", callback_data="325uc")],
-            [InlineKeyboardButton(f"660 UC: {prices['660']}", callback_data="660uc")],
-            [InlineKeyboardButton(f"1800 UC: {prices['1800']}", callback_data="1800uc")],
-            [InlineKeyboardButton(f"3850 UC: {prices['3850']}", callback_data="3850uc")],
-            [InlineKeyboardButton(f"8100 UC: {prices['8100']}", callback_data="8100uc")]
-        ])
-        await update.message.reply_text(TRANSLATIONS[lang]['choose_uc'], reply_markup=keyboard)
+        await update.message.reply_text(TRANSLATIONS[lang]['choose_uc'], reply_markup=catalog.keyboard(lang))
     except Exception as e:
         logger.error(f"Buy UC command failed: {e}")
 
@@ -228,21 +293,38 @@ async def button_callback(update: Update, context):
     await query.answer()
     user_id = query.from_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
-
-        if query.data in ["60uc", "325uc", "660uc", "1800uc", "3850uc", "8100uc"]:
-            context.user_data['selected_uc'] = query.data.replace("uc", "")
-            uc_amount = context.user_data['selected_uc']
-            prices = load_prices()
-            price = prices.get(uc_amount, "неизвестно")
-            discount = context.user_data.get('discount', 0)
-            if discount:
-                price_value = float(price.replace(" ₽", ""))
-                price = f"{price_value * (1 - discount):.2f} ₽ (скидка {discount*100}%)"
+        lang = await get_language(user_id)
+
+        package = catalog.package_from_callback(query.data)
+        if package:
+            context.user_data['selected_uc'] = package
+            uc_amount = package
+            promo_code = context.user_data.get('promo')
+            full_kopecks = catalog.price_kopecks(uc_amount)
+
+            # Промокод списывается в той же транзакции, что и заказ:
+            # если лимит уже исчерпан, заказ оформляется по полной цене
+            def place_order(conn):
+                discount = promo_codes.claim(conn, promo_code, user_id) if promo_code else 0
+                price_kopecks = apply_discount(full_kopecks, discount)
+                price = format_price(price_kopecks)
+                if discount:
+                    price = f"{price} (скидка {format_percent(discount)})"
+                bonuses = price_kopecks // 100000
+                order_id = orders.insert_order(conn, user_id, uc_amount, price, price_kopecks)
+                if discount:
+                    promo_codes.record(conn, promo_code, user_id, order_id)
+                ledger.credit(conn, user_id, bonuses, 'order', order_id=order_id)
+                schedule_reminder(conn, user_id)
+                return discount, price, bonuses
+
+            # Заказ фиксируется до того, как пользователь увидит подтверждение
+            discount, price, bonuses = await writes.submit(place_order)
+            profiles.add_bonuses(user_id, bonuses)
+            if promo_code:
+                context.user_data.pop('promo', None)
+                if discount:
+                    promos.note_redeemed(promo_code, user_id)
 
             keyboard = InlineKeyboardMarkup([
                 [InlineKeyboardButton("Ввести ID" if lang == 'ru' else "Enter ID", callback_data="enter_id")],
@@ -257,25 +339,17 @@ async def button_callback(update: Update, context):
                 reply_markup=keyboard
             )
 
-            conn = sqlite3.connect('/opt/data/bot.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO orders (user_id, uc_amount, price, status, timestamp) VALUES (?, ?, ?, ?, ?)",
-                      (user_id, uc_amount, price, 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-            conn.commit()
-
-            price_value = float(price.split()[0])
-            bonuses = int(price_value // 1000)
-            c.execute("UPDATE users SET bonuses = bonuses + ? WHERE user_id = ?", (bonuses, user_id))
-            conn.commit()
+            if promo_code and not discount:
+                await query.message.reply_text(TRANSLATIONS[lang]['promo_not_applied'])
 
-            await context.bot.send_message(
+            outbox.notify_admin(
                 ADMIN_ID,
                 f"Новый заказ:\nПользователь: @{query.from_user.username or 'не указан'}\nUC: {uc_amount}\nЦена: {price}"
             )
 
         elif query.data == "enter_id":
             await query.message.reply_text(TRANSLATIONS[lang]['enter_id'])
-            context.user_data['waiting_for_id'] = True
+            set_state(context, STATE_AWAITING_ID)
 
         elif query.data == "pay":
             player_id = context.user_data.get('player_id', 'не указан')
@@ -284,45 +358,34 @@ async def button_callback(update: Update, context):
                 TRANSLATIONS[lang]['payment'].format(uc_amount=uc_amount, player_id=player_id)
             )
 
-            price = float(load_prices().get(uc_amount, "0").replace(" ₽", ""))
-            bonus = int(price * 0.05)
-            conn = sqlite3.connect('/opt/data/bot.db')
-            c = conn.cursor()
-            c.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
-            referred_by = c.fetchone()
-            if referred_by and referred_by[0]:
-                c.execute("UPDATE users SET bonuses = bonuses + ? WHERE user_id = ?", (bonus, int(referred_by[0])))
-            conn.commit()
-            conn.close()
+            bonus = (catalog.price_kopecks(uc_amount) or 0) * 5 // 10000
+
+            referred_by = (await profiles.get(user_id)).referred_by
+            if referred_by:
+                # Бонус пригласившему привязан к заказу и начисляется один раз
+                def credit_referrer(conn):
+                    order_id = orders.latest_pending_order_id(conn, user_id)
+                    return order_id is not None and ledger.credit(
+                        conn, referred_by, bonus, 'referral', order_id=order_id, source_user_id=user_id
+                    )
+
+                if await writes.submit(credit_referrer):
+                    profiles.add_bonuses(referred_by, bonus)
     except Exception as e:
         logger.error(f"Button callback failed: {e}")
 
-async def handle_player_id(update: Update, context):
-    if await check_ban(update, context):
-        return
-    user_id = update.effective_user.id
+async def handle_player_id(update: Update, context, profile):
+    user_id = profile.user_id
+    lang = profile.language
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
-
-        if context.user_data.get('waiting_for_id', False):
-            player_id = update.message.text
-            if not is_valid_player_id(player_id):
-                await update.message.reply_text(TRANSLATIONS[lang]['invalid_id'])
-                return
-            context.user_data['player_id'] = player_id
-            context.user_data['waiting_for_id'] = False
-            await update.message.reply_text(TRANSLATIONS[lang]['id_saved'].format(player_id=player_id))
-
-            conn = sqlite3.connect('/opt/data/bot.db')
-            c = conn.cursor()
-            c.execute("UPDATE orders SET player_id = ? WHERE user_id = ? AND status = 'pending'",
-                      (player_id, user_id))
-            conn.commit()
-            conn.close()
+        player_id = update.message.text.strip()
+        if not is_valid_player_id(player_id):
+            await update.message.reply_text(TRANSLATIONS[lang]['invalid_id'])
+            return
+        context.user_data['player_id'] = player_id
+        set_state(context, STATE_IDLE)
+        await writes.submit(lambda conn: orders.set_pending_player_id(conn, user_id, player_id))
+        await update.message.reply_text(TRANSLATIONS[lang]['id_saved'].format(player_id=player_id))
     except Exception as e:
         logger.error(f"Handle player ID failed: {e}")
 
@@ -331,96 +394,121 @@ async def handle_screenshot(update: Update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
+        lang = await get_language(user_id)
 
         if update.message.photo:
             await update.message.reply_text(TRANSLATIONS[lang]['screenshot_received'])
-            await context.bot.send_photo(
-                ADMIN_ID,
-                update.message.photo[-1].file_id,
-                caption=f"Скриншот платежа от @{update.effective_user.username or 'не указан'}"
-            )
+            photo = update.message.photo[-1]
+            caption = f"Скриншот платежа от @{update.effective_user.username or 'не указан'} ({user_id})"
+            try:
+                check = await screenshot_checker.check(context.bot, user_id, photo)
+                caption += screenshot_note(check, user_id)
+            except Exception as e:
+                # Проверка не должна задерживать скриншот: админ получит его без пометки
+                logger.error(f"Screenshot check failed for {user_id}: {e}")
+            outbox.send_photo(ADMIN_ID, photo.file_id, caption=caption)
     except Exception as e:
         logger.error(f"Handle screenshot failed: {e}")
 
+def screenshot_note(check, user_id):
+    note = f", заказ #{check.order_id}" if check.order_id else ", нет ожидающего заказа"
+    if check.duplicate_of is None:
+        return note
+    if check.duplicate_user_id == user_id and check.duplicate_order_id == check.order_id:
+        return note + f"\n⚠️ Повторная отправка скриншота #{check.duplicate_of}"
+    source = f"пользователя {check.duplicate_user_id}" if check.duplicate_user_id != user_id else "этого же пользователя"
+    order = f" к заказу #{check.duplicate_order_id}" if check.duplicate_order_id else ""
+    return note + (f"\n⚠️ Возможный дубликат: скриншот #{check.duplicate_of} от {source}{order} "
+                   f"(отличие {check.distance} из {HASH_BITS})")
+
 async def promo(update: Update, context):
     if await check_ban(update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
+        lang = await get_language(user_id)
 
         await update.message.reply_text(TRANSLATIONS[lang]['promo_prompt'])
-        context.user_data['waiting_for_promo'] = True
+        set_state(context, STATE_AWAITING_PROMO)
     except Exception as e:
         logger.error(f"Promo command failed: {e}")
 
-async def handle_promo(update: Update, context):
-    if await check_ban(update, context):
-        return
-    user_id = update.effective_user.id
+async def handle_promo(update: Update, context, profile):
+    lang = profile.language
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-
-        if context.user_data.get('waiting_for_promo', False):
-            promo_code = update.message.text.upper()
-            c.execute("SELECT discount FROM promos WHERE code = ?", (promo_code,))
-            result = c.fetchone()
-            if result:
-                context.user_data['discount'] = result[0]
-                await update.message.reply_text(
-                    TRANSLATIONS[lang]['promo_success'].format(discount=result[0]*100)
-                )
-            else:
-                await update.message.reply_text(TRANSLATIONS[lang]['promo_invalid'])
-            context.user_data['waiting_for_promo'] = False
-        conn.close()
+        # Проверка по индексу в памяти; списание — только вместе с заказом
+        found, error = await promos.check(update.message.text, profile.user_id)
+        if found:
+            context.user_data['promo'] = found.code
+            await update.message.reply_text(
+                TRANSLATIONS[lang]['promo_success'].format(discount=format_percent(found.discount))
+            )
+        else:
+            context.user_data.pop('promo', None)
+            await update.message.reply_text(TRANSLATIONS[lang][error])
+        set_state(context, STATE_IDLE)
     except Exception as e:
         logger.error(f"Handle promo failed: {e}")
 
+HISTORY_PAGE_SIZE = 10
+
+async def render_history(user_id, lang, direction='first', cursor=None):
+    def read_page(conn):
+        # Архив читается по индексу пользователя, поэтому история видна целиком
+        page = orders.fetch_orders_page(conn, direction, cursor, user_id=user_id, limit=HISTORY_PAGE_SIZE,
+                                        include_archive=True)
+        return page, stats.read_user_summary(conn, user_id)
+
+    (rows, has_older, has_newer), (count, spent) = await db.read(read_page)
+    if not rows:
+        return TRANSLATIONS[lang]['history_empty'], None
+    history_text = "\n".join(f"{format_timestamp(o[5])}: {o[2]} UC, {o[3]}, {o[4]}" for o in rows)
+    text = TRANSLATIONS[lang]['history'].format(history=history_text) + "\n\n" + \
+        TRANSLATIONS[lang]['history_summary'].format(count=count, spent=format_price(spent))
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(TRANSLATIONS[lang]['history_newer'],
+                                               callback_data=f"history:newer:{rows[0][5]}:{rows[0][0]}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton(TRANSLATIONS[lang]['history_older'],
+                                               callback_data=f"history:older:{rows[-1][5]}:{rows[-1][0]}"))
+    return text, InlineKeyboardMarkup([navigation]) if navigation else None
+
 async def history(update: Update, context):
     if await check_ban(update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        c.execute("SELECT uc_amount, price, status, timestamp FROM orders WHERE user_id = ?", (user_id,))
-        orders = c.fetchall()
-        conn.close()
+        lang = await get_language(user_id)
+        text, keyboard = await render_history(user_id, lang)
+        await update.message.reply_text(text, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"History command failed: {e}")
 
-        if not orders:
-            await update.message.reply_text("У вас пока нет заказов." if lang == 'ru' else "You have no orders yet.")
+async def history_callback(update: Update, context):
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    try:
+        # Старые кнопки истории остаются в чате и после блокировки
+        profile = await profiles.get(user_id)
+        if profile.banned:
+            await query.message.edit_text(TRANSLATIONS['ru']['banned'])
             return
-        history_text = "\n".join([f"{o[3]}: {o[0]} UC, {o[1]}, {o[2]}" for o in orders])
-        await update.message.reply_text(TRANSLATIONS[lang]['history'].format(history=history_text))
+        lang = profile.language
+        _, direction, created_at, order_id = query.data.split(':')
+        text, keyboard = await render_history(user_id, lang, direction, (int(created_at), int(order_id)))
+        await query.message.edit_text(text, reply_markup=keyboard)
     except Exception as e:
-        logger.error(f"History command failed: {e}")
+        logger.error(f"History callback failed: {e}")
 
 async def bonuses(update: Update, context):
     if await check_ban(update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language, bonuses FROM users WHERE user_id = ?", (user_id,))
-        lang, bonuses = c.fetchone()
-        conn.close()
-        await update.message.reply_text(TRANSLATIONS[lang]['bonuses'].format(bonuses=bonuses))
+        profile = await profiles.get(user_id)
+        await update.message.reply_text(TRANSLATIONS[profile.language]['bonuses'].format(bonuses=profile.bonuses))
     except Exception as e:
         logger.error(f"Bonuses command failed: {e}")
 
@@ -429,39 +517,34 @@ async def custom_uc(update: Update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
+        lang = await get_language(user_id)
         await update.message.reply_text(TRANSLATIONS[lang]['custom_uc'])
-        context.user_data['waiting_for_custom_uc'] = True
+        set_state(context, STATE_AWAITING_CUSTOM_UC)
     except Exception as e:
         logger.error(f"Custom UC command failed: {e}")
 
-async def handle_custom_uc(update: Update, context):
-    if await check_ban(update, context):
-        return
-    user_id = update.effective_user.id
+async def handle_custom_uc(update: Update, context, profile):
+    lang = profile.language
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
-
-        if context.user_data.get('waiting_for_custom_uc', False):
-            try:
-                uc_amount = int(update.message.text)
-                if uc_amount <= 0:
-                    raise ValueError
-                price = uc_amount * 1.5
-                await update.message.reply_text(
-                    TRANSLATIONS[lang]['custom_result'].format(uc_amount=uc_amount, price=price)
+        try:
+            uc_amount = int(update.message.text)
+        except ValueError:
+            uc_amount = 0
+        discount = 0
+        if context.user_data.get('promo'):
+            found, _ = await promos.check(context.user_data['promo'], profile.user_id)
+            discount = found.discount if found else 0
+        quote = catalog.quote(uc_amount, discount)
+        if quote:
+            packages = " + ".join(f"{count} × {uc} UC" for uc, count in quote.packages)
+            await update.message.reply_text(
+                TRANSLATIONS[lang]['custom_result'].format(
+                    uc_amount=uc_amount, price=format_price(quote.kopecks), packages=packages, covered=quote.covered
                 )
-            except ValueError:
-                await update.message.reply_text("Введите положительное число.")
-            context.user_data['waiting_for_custom_uc'] = False
+            )
+        else:
+            await update.message.reply_text(TRANSLATIONS[lang]['custom_invalid'].format(max_uc=MAX_CUSTOM_UC))
+        set_state(context, STATE_IDLE)
     except Exception as e:
         logger.error(f"Handle custom UC failed: {e}")
 
@@ -470,15 +553,16 @@ async def referral(update: Update, context):
         return
     user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language, referral_code FROM users WHERE user_id = ?", (user_id,))
-        lang, referral_code = c.fetchone()
-        if not referral_code:
-            referral_code = f"ref{user_id}"
-            c.execute("UPDATE users SET referral_code = ? WHERE user_id = ?", (referral_code, user_id))
-            conn.commit()
-        conn.close()
+        def ensure_code(conn):
+            c = conn.cursor()
+            c.execute("SELECT language, referral_code FROM users WHERE user_id = ?", (user_id,))
+            lang, referral_code = c.fetchone()
+            if not referral_code:
+                referral_code = f"ref{user_id}"
+                c.execute("UPDATE users SET referral_code = ? WHERE user_id = ?", (referral_code, user_id))
+            return lang, referral_code
+
+        lang, referral_code = await db.write(ensure_code)
         link = f"t.me/YourBot?start={referral_code}"
         await update.message.reply_text(TRANSLATIONS[lang]['referral'].format(link=link))
     except Exception as e:
@@ -503,11 +587,8 @@ async def set_language(update: Update, context):
     user_id = query.from_user.id
     try:
         lang = 'ru' if query.data == "lang_ru" else 'en'
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("UPDATE users SET language = ? WHERE user_id = ?", (lang, user_id))
-        conn.commit()
-        conn.close()
+        await db.execute("UPDATE users SET language = ? WHERE user_id = ?", (lang, user_id))
+        profiles.update(user_id, language=lang)
         await query.message.reply_text("Язык изменен / Language changed.")
     except Exception as e:
         logger.error(f"Set language failed: {e}")
@@ -521,7 +602,8 @@ async def admin(update: Update, context):
         keyboard = InlineKeyboardMarkup([
             [InlineKeyboardButton("Просмотреть заказы", callback_data="admin_orders")],
             [InlineKeyboardButton("Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("Заблокировать пользователя", callback_data="admin_ban")]
+            [InlineKeyboardButton("Заблокировать пользователя", callback_data="admin_ban")],
+            [InlineKeyboardButton("Рассылка", callback_data="admin_broadcast")]
         ])
         await update.message.reply_text("Админ-панель:", reply_markup=keyboard)
     except Exception as e:
@@ -534,141 +616,538 @@ async def admin_callback(update: Update, context):
         await query.message.reply_text("Доступ запрещен.")
         return
     try:
-        if query.data == "admin_orders":
-            conn = sqlite3.connect('/opt/data/bot.db')
-            c = conn.cursor()
-            c.execute("SELECT user_id, uc_amount, price, status, timestamp FROM orders")
-            orders = c.fetchall()
-            conn.close()
-            if not orders:
-                await query.message.reply_text("Заказов нет.")
-                return
-            orders_text = "\n".join([f"ID: {o[0]}, UC: {o[1]}, Цена: {o[2]}, Статус: {o[3]}, Время: {o[4]}" for o in orders])
-            await query.message.reply_text(f"Заказы:\n{orders_text}")
+        if query.data == orders.PAGE_CALLBACK:
+            await show_orders_page(query.message)
+
+        elif query.data.startswith(f"{orders.PAGE_CALLBACK}:"):
+            direction, cursor, status, user_id, include_archive = orders.parse_page_callback(query.data)
+            await show_orders_page(query.message, direction, cursor, status, user_id, include_archive, edit=True)
 
         elif query.data == "admin_stats":
-            conn = sqlite3.connect('/opt/data/bot.db')
-            c = conn.cursor()
-            c.execute("SELECT COUNT(*), SUM(CAST(REPLACE(price, ' ₽', '') AS REAL)) FROM orders")
-            count, total = c.fetchone()
-            c.execute("SELECT uc_amount, COUNT(*) FROM orders GROUP BY uc_amount ORDER BY COUNT(*) DESC LIMIT 1")
-            popular = c.fetchone()
-            conn.close()
-            stats = f"Заказов: {count}\nОбщая выручка: {total or 0:.2f} ₽\nПопулярный пакет: {popular[0]} UC ({popular[1]} заказов)"
-            await query.message.reply_text(stats)
+            sales = await db.read(stats.read_stats)
+            popular = sales['popular'] or ('—', 0)
+            cache = profiles.stats()
+            text = f"Заказов: {sales['count']}\nОбщая выручка: {format_price(sales['revenue_kop'])}\n" \
+                   f"Сегодня: {sales['today_count']} заказов, {format_price(sales['today_revenue_kop'])}\n" \
+                   f"Популярный пакет: {popular[0]} UC ({popular[1]} заказов)\n" \
+                   f"Кэш профилей: {cache['hits']} попаданий / {cache['misses']} промахов ({cache['hit_rate']:.0%})"
+            await query.message.reply_text(text)
 
         elif query.data == "admin_ban":
             await query.message.reply_text("Введите ID пользователя для блокировки:")
-            context.user_data['waiting_for_ban'] = True
+            set_state(context, STATE_AWAITING_BAN)
+
+        elif query.data == "admin_broadcast":
+            await query.message.reply_text("Введите текст рассылки для всех пользователей:")
+            set_state(context, STATE_AWAITING_BROADCAST)
+
+        elif query.data == "admin_broadcast_send":
+            text = context.user_data.pop('broadcast_text', None)
+            if not text:
+                await query.message.edit_text("Черновик рассылки не найден.")
+                return
+            broadcast_id = await db.write(lambda conn: broadcast.create_broadcast(conn, text, query.from_user.id))
+            broadcaster.start(context.bot, broadcast_id)
+            await query.message.edit_text(f"Рассылка #{broadcast_id} запущена.")
+
+        elif query.data == "admin_broadcast_discard":
+            context.user_data.pop('broadcast_text', None)
+            await query.message.edit_text("Рассылка отменена.")
+
+        elif query.data.startswith(f"{broadcast.STOP_CALLBACK}:"):
+            await broadcaster.pause(context.bot, int(query.data.rsplit(':', 1)[1]))
+
+        elif query.data.startswith(f"{broadcast.RESUME_CALLBACK}:"):
+            broadcaster.start(context.bot, int(query.data.rsplit(':', 1)[1]))
     except Exception as e:
         logger.error(f"Admin callback failed: {e}")
 
-async def handle_admin_ban(update: Update, context):
+async def show_orders_page(message, direction='first', cursor=None, status=None, user_id=None, include_archive=False,
+                           edit=False):
+    rows, has_older, has_newer = await db.read(
+        lambda conn: orders.fetch_orders_page(conn, direction, cursor, status, user_id,
+                                              include_archive=include_archive))
+    filters_text = (f" (статус: {status or 'все'}{f', пользователь: {user_id}' if user_id else ''}"
+                    f"{', с архивом' if include_archive else ''})")
+    if rows:
+        text = f"Заказы{filters_text}:\n" + "\n".join(
+            f"#{o[0]} {format_timestamp(o[5])} ID: {o[1]}, UC: {o[2]}, Цена: {o[3]}, Статус: {o[4]}" for o in rows)
+    else:
+        text = f"Заказов нет{filters_text}."
+    navigation = []
+    if has_newer and rows:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=orders.page_callback('newer', rows[0], status, user_id, include_archive)))
+    if has_older and rows:
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=orders.page_callback('older', rows[-1], status, user_id, include_archive)))
+    status_filters = [
+        InlineKeyboardButton(("• " if value == status else "") + (value or "все"),
+                             callback_data=orders.page_callback('first', None, value, user_id, include_archive))
+        for value in (None,) + orders.ORDER_STATUSES
+    ]
+    keyboard = InlineKeyboardMarkup([row for row in (navigation, status_filters) if row])
+    if edit:
+        await message.edit_text(text, reply_markup=keyboard)
+    else:
+        await message.reply_text(text, reply_markup=keyboard)
+
+async def orders_command(update: Update, context):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Доступ запрещен.")
         return
     try:
-        if context.user_data.get('waiting_for_ban', False):
-            try:
-                ban_id = int(update.message.text)
-                conn = sqlite3.connect('/opt/data/bot.db')
-                c = conn.cursor()
-                c.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (ban_id,))
-                conn.commit()
-                conn.close()
-                await update.message.reply_text(f"Пользователь {ban_id} заблокирован.")
-            except ValueError:
-                await update.message.reply_text("Введите корректный ID.")
-            context.user_data['waiting_for_ban'] = False
+        status, user_id, include_archive = None, None, False
+        for arg in context.args or []:
+            if arg.isdigit():
+                user_id = int(arg)
+            elif arg in orders.ORDER_STATUSES:
+                status = arg
+            elif arg.lower() == export.ARCHIVE_ARG:
+                include_archive = True
+        await show_orders_page(update.message, status=status, user_id=user_id, include_archive=include_archive)
+    except Exception as e:
+        logger.error(f"Orders command failed: {e}")
+
+EXPORT_USAGE = ("Использование: /export [С] [ПО] [статус] [csv|jsonl] [archive]\n"
+                "Даты в формате ГГГГ-ММ-ДД, например: /export 2024-01-01 2024-01-31 completed jsonl\n"
+                "archive добавляет заказы, перенесённые в архив")
+
+async def export_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        try:
+            since, until, status, fmt, include_archive, filename = export.parse_export_args(
+                context.args or [], orders.ORDER_STATUSES)
+        except ValueError:
+            await update.message.reply_text(EXPORT_USAGE)
+            return
+        await update.message.reply_text("Выгрузка заказов запущена…")
+        # Чтение и сжатие идут в отдельном потоке, цикл событий не блокируется
+        loop = asyncio.get_running_loop()
+        path, count = await loop.run_in_executor(
+            None, lambda: export.export_orders(db, since, until, status, fmt, include_archive=include_archive)
+        )
+        try:
+            if os.path.getsize(path) > export.MAX_DOCUMENT_SIZE:
+                await update.message.reply_text(f"Файл слишком большой ({count} заказов), сузьте период.")
+                return
+            with open(path, 'rb') as f:
+                await update.message.reply_document(f, filename=filename, caption=f"Заказов: {count}",
+                                                    write_timeout=120)
+        finally:
+            os.remove(path)
+    except Exception as e:
+        logger.error(f"Export command failed: {e}")
+
+async def handle_admin_ban(update: Update, context, profile):
+    if profile.user_id != ADMIN_ID:
+        set_state(context, STATE_IDLE)
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        try:
+            ban_id = int(update.message.text)
+            await db.execute("INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)", (ban_id,))
+            profiles.update(ban_id, banned=True)
+            await update.message.reply_text(f"Пользователь {ban_id} заблокирован.")
+        except ValueError:
+            await update.message.reply_text("Введите корректный ID.")
+        set_state(context, STATE_IDLE)
     except Exception as e:
         logger.error(f"Handle admin ban failed: {e}")
 
-async def reminder(context):
-    job = context.job
-    user_id = job.data['user_id']
+async def handle_admin_broadcast(update: Update, context, profile):
+    set_state(context, STATE_IDLE)
+    if profile.user_id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        text = update.message.text
+        context.user_data['broadcast_text'] = text
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Отправить всем", callback_data="admin_broadcast_send")],
+            [InlineKeyboardButton("Отмена", callback_data="admin_broadcast_discard")]
+        ])
+        await update.message.reply_text(f"Предпросмотр рассылки:\n\n{text}", reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Handle admin broadcast failed: {e}")
+
+async def rebuild_stats(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        c.execute("SELECT uc_amount FROM orders WHERE user_id = ? AND status = 'pending' ORDER BY timestamp DESC LIMIT 1", (user_id,))
-        result = c.fetchone()
-        conn.close()
-        if result:
-            await context.bot.send_message(user_id, TRANSLATIONS[lang]['reminder'].format(uc_amount=result[0]))
+        count = await db.write(stats.rebuild_aggregates)
+        await update.message.reply_text(f"Статистика пересчитана: {count} заказов.")
     except Exception as e:
-        logger.error(f"Reminder failed: {e}")
+        logger.error(f"Rebuild stats failed: {e}")
 
-async def simple_chatbot(update: Update, context):
-    if await check_ban(update, context):
+# /archive — размер живой таблицы и архива, /archive run — просрочить и перенести старые заказы сейчас
+async def archive_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        result = None
+        if context.args and context.args[0].lower() == 'run':
+            result = await order_archiver.run_once()
+        live, archived = await db.read(archive.archive_counts)
+        text = (f"Заказов в рабочей таблице: {live}, в архиве: {archived}.\n"
+                f"Неоплаченные заказы просрочиваются через {ORDER_EXPIRE_HOURS} ч, "
+                f"завершённые и просроченные переносятся в архив через {ARCHIVE_AFTER_DAYS} дн.")
+        if result is not None:
+            text = f"Просрочено: {result[0]}, перенесено в архив: {result[1]}.\n" + text
+        await update.message.reply_text(text)
+    except Exception as e:
+        logger.error(f"Archive command failed: {e}")
+
+# Подтверждение выполненного заказа: /complete НОМЕР
+async def complete_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        if len(context.args) != 1 or not context.args[0].isdigit():
+            await update.message.reply_text("Использование: /complete НОМЕР_ЗАКАЗА")
+            return
+        order_id = int(context.args[0])
+        row = await writes.submit(lambda conn: orders.complete_order(conn, order_id))
+        if row is None:
+            await update.message.reply_text(f"Заказ №{order_id} не найден или уже выполнен.")
+            return
+        user_id, uc_amount = row
+        lang = await get_language(user_id)
+        outbox.send_message(
+            user_id, TRANSLATIONS[lang]['order_completed'].format(order_id=order_id, uc_amount=uc_amount)
+        )
+        await update.message.reply_text(f"Заказ №{order_id} отмечен выполненным.")
+    except Exception as e:
+        logger.error(f"Complete command failed: {e}")
+
+PROMO_SET_USAGE = ("Использование: /promo_set КОД ПРОЦЕНТ [ДНЕЙ] [ВСЕГО] [НА_ПОЛЬЗОВАТЕЛЯ]\n"
+                   "0 или - означает «без ограничения», например: /promo_set SPRING15 15 30 500 1")
+
+def _limit_arg(args, index):
+    if len(args) <= index or args[index] in ('0', '-'):
+        return None
+    value = int(args[index])
+    if value < 0:
+        raise ValueError
+    return value
+
+async def promo_set(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        args = context.args or []
+        try:
+            code = promo_codes.normalize_code(args[0])
+            discount = round(float(args[1].replace(',', '.').rstrip('%')) * 100)
+            if not 0 < discount < BASIS_POINTS:
+                raise ValueError
+            days = _limit_arg(args, 2)
+            max_uses = _limit_arg(args, 3)
+            per_user_limit = _limit_arg(args, 4)
+        except (IndexError, ValueError):
+            await update.message.reply_text(PROMO_SET_USAGE)
+            return
+        expires_at = int(time.time()) + days * 86400 if days else None
+        await writes.submit(lambda conn: promo_codes.upsert(
+            conn, code, discount / BASIS_POINTS, expires_at, max_uses, per_user_limit
+        ))
+        await promos.refresh()
+        await update.message.reply_text(
+            f"Промокод {code}: скидка {format_percent(discount)}, "
+            f"до {format_timestamp(expires_at) if expires_at else 'бессрочно'}, "
+            f"всего {max_uses or '∞'}, на пользователя {per_user_limit or '∞'}."
+        )
+    except Exception as e:
+        logger.error(f"Promo set failed: {e}")
+
+async def promo_off(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        if not context.args:
+            await update.message.reply_text("Использование: /promo_off КОД")
+            return
+        code = promo_codes.normalize_code(context.args[0])
+        changed = await writes.submit(lambda conn: promo_codes.deactivate(conn, code))
+        await promos.refresh()
+        await update.message.reply_text(f"Промокод {code} отключен." if changed else f"Промокод {code} не найден.")
+    except Exception as e:
+        logger.error(f"Promo off failed: {e}")
+
+async def promos_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        rows = await db.read(promo_codes.list_promos)
+        lines = [
+            f"{code}: {format_percent(round(discount * BASIS_POINTS))}, использован {used}"
+            f"{f' из {max_uses}' if max_uses else ''}"
+            f"{f', на пользователя {per_user}' if per_user else ''}"
+            f"{f', до {format_timestamp(expires_at)}' if expires_at else ''}"
+            f"{'' if active else ' (отключен)'}"
+            for code, discount, expires_at, max_uses, per_user, used, active in rows
+        ]
+        await update.message.reply_text("Промокоды:\n" + "\n".join(lines) if lines else "Промокодов нет.")
+    except Exception as e:
+        logger.error(f"Promos command failed: {e}")
+
+def send_reminder(user_id, lang, uc_amount):
+    outbox.send_message(user_id, TRANSLATIONS[lang]['reminder'].format(uc_amount=uc_amount))
+
+reminder_scheduler = ReminderScheduler(db, send_reminder)
+bonus_compactor = BonusCompactor(db)
+order_archiver = OrderArchiver(db, max_age_days=ARCHIVE_AFTER_DAYS, expire_after_hours=ORDER_EXPIRE_HOURS)
+broadcaster = Broadcaster(db, outbox)
+screenshot_checker = ScreenshotChecker(db)
+
+def _user_arg(context):
+    args = context.args or []
+    return int(args[0]) if args and args[0].isdigit() else None
+
+async def referrals_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        user_id = _user_arg(context)
+        if user_id is None:
+            await update.message.reply_text("Использование: /referrals ID_ПОЛЬЗОВАТЕЛЯ")
+            return
+        levels, members = await db.read(lambda conn: ledger.referral_tree(conn, user_id))
+        if not levels:
+            await update.message.reply_text(f"У пользователя {user_id} нет приглашённых.")
+            return
+        lines = [f"Приглашённые пользователя {user_id}:",
+                 ", ".join(f"уровень {depth}: {count}" for depth, count in levels)]
+        lines += [f"{'  ' * (depth - 1)}{member}: заказов {count}, {format_price(spent)}"
+                  for member, depth, count, spent in members]
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Referrals command failed: {e}")
+
+async def top_referrers_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
         return
-    user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect('/opt/data/bot.db')
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang = c.fetchone()[0]
-        conn.close()
-
-        text = update.message.text.lower()
-        responses = {
-            'ru': {
-                'как долго ждать': "UC будут зачислены в течение 10-30 минут после подтверждения платежа.",
-                'где мой заказ': "Проверьте статус заказа с помощью команды /history.",
-                'как оплатить': "Используйте команду /buy_uc, выберите пакет UC, введите ID игрока и следуйте инструкциям."
-            },
-            'en': {
-                'how long to wait': "UC will be credited within 10-30 minutes after payment confirmation.",
-                'where is my order': "Check your order status with the /history command.",
-                'how to pay': "Use the /buy_uc command, select a UC package, enter your player ID, and follow the instructions."
-            }
-        }
-        response = responses[lang].get(text, "Извините, я не понял. Используйте /start для списка команд." if lang == 'ru' else "Sorry, I didn't understand. Use /start for a list of commands.")
+        rows = await db.read(ledger.top_referrers)
+        if not rows:
+            await update.message.reply_text("Рефералов пока нет.")
+            return
+        lines = ["Лучшие пригласившие (прямые / вся сеть / бонусы):"]
+        lines += [f"{user_id}: {direct} / {network} / {earned}" for user_id, direct, network, earned in rows]
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Top referrers command failed: {e}")
+
+async def bonus_audit(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        user_id = _user_arg(context)
+        if user_id is None:
+            mismatches = await db.read(ledger.audit)
+            if not mismatches:
+                await update.message.reply_text("Балансы совпадают с журналом бонусов.")
+                return
+            lines = ["Расхождения снимка с журналом (пользователь: снимок / журнал):"]
+            lines += [f"{uid}: {snapshot} / {total}" for uid, snapshot, total in mismatches]
+            await update.message.reply_text("\n".join(lines))
+            return
+
+        def read_user(conn):
+            return ledger.balance(conn, user_id), ledger.recent_entries(conn, user_id)
+
+        balance, entries = await db.read(read_user)
+        lines = [f"Баланс {user_id}: {balance}"]
+        lines += [f"#{entry_id} {format_timestamp(created_at)}: {delta:+d} {reason}"
+                  f"{f', заказ {order_id}' if order_id else ''}{f', от {source}' if source else ''}"
+                  for entry_id, delta, reason, order_id, source, created_at in entries]
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Bonus audit failed: {e}")
+
+async def simple_chatbot(update: Update, context, profile):
+    lang = profile.language
+    try:
+        response = faq.answer(update.message.text, lang) or (
+            "Извините, я не понял. Используйте /start для списка команд." if lang == 'ru'
+            else "Sorry, I didn't understand. Use /start for a list of commands."
+        )
         await update.message.reply_text(response)
     except Exception as e:
         logger.error(f"Simple chatbot failed: {e}")
 
+TEXT_STATE_HANDLERS = {
+    STATE_IDLE: simple_chatbot,
+    STATE_AWAITING_ID: handle_player_id,
+    STATE_AWAITING_PROMO: handle_promo,
+    STATE_AWAITING_CUSTOM_UC: handle_custom_uc,
+    STATE_AWAITING_BAN: handle_admin_ban,
+    STATE_AWAITING_BROADCAST: handle_admin_broadcast,
+}
+
+async def dispatch_text(update: Update, context):
+    user_id = update.effective_user.id
+    try:
+        profile = await profiles.get(user_id)
+        if profile.banned:
+            await update.message.reply_text(TRANSLATIONS['ru']['banned'])
+            return
+        state = context.user_data.get(STATE_KEY, STATE_IDLE)
+        handler = TEXT_STATE_HANDLERS.get(state, simple_chatbot)
+        await handler(update, context, profile)
+    except Exception as e:
+        logger.error(f"Text dispatch failed: {e}")
+
+def register_metrics(application):
+    db.observer = observe_db
+    logging.getLogger().addHandler(ErrorCounter())
+    metrics.gauge('bot_profile_cache_hit_ratio', lambda: profiles.stats()['hit_rate'])
+    metrics.gauge('bot_profile_cache_size', lambda: profiles.stats()['size'])
+    metrics.gauge('bot_write_queue_depth', lambda: writes.depth)
+    metrics.gauge('bot_write_batches', lambda: writes.batches)
+    metrics.gauge('bot_outbox_depth', lambda: outbox.depth)
+    metrics.gauge('bot_outbox_sent', lambda: outbox.sent)
+    metrics.gauge('bot_outbox_failed', lambda: outbox.failed)
+    metrics.gauge('bot_reminders_sent', lambda: reminder_scheduler.sent)
+    metrics.gauge('bot_promos_active', lambda: promos.stats()['active'])
+    metrics.gauge('bot_bonus_entries_compacted', lambda: bonus_compactor.compacted)
+    metrics.gauge('bot_orders_archived', lambda: order_archiver.archived)
+    metrics.gauge('bot_orders_expired', lambda: order_archiver.expired)
+    metrics.gauge('bot_broadcasts_active', lambda: broadcaster.active)
+    metrics.gauge('bot_screenshots_checked', lambda: screenshot_checker.checked)
+    metrics.gauge('bot_screenshots_duplicates', lambda: screenshot_checker.duplicates)
+    metrics.gauge('bot_active_users_in_flight', lambda: application.update_processor.active_keys)
+    instrument_application(application)
+
+async def metrics_command(update: Update, context):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Доступ запрещен.")
+        return
+    try:
+        lines = ["Обработчики (вызовы, p50/p95/p99 мс):"]
+        for labels, histogram in metrics.summary('bot_handler_seconds'):
+            errors = metrics.counters.get(('bot_handler_errors_total', (('handler', labels['handler']),)), 0)
+            lines.append(f"{labels['handler']}: {histogram.count}, "
+                         f"{histogram.quantile(0.5) * 1000:.1f}/{histogram.quantile(0.95) * 1000:.1f}/"
+                         f"{histogram.quantile(0.99) * 1000:.1f}" + (f", ошибок: {errors}" if errors else ""))
+        for labels, histogram in metrics.summary('bot_db_seconds'):
+            lines.append(f"БД {labels['kind']}: {histogram.count}, p95 {histogram.quantile(0.95) * 1000:.1f} мс")
+        cache = profiles.stats()
+        lines.append(f"Кэш профилей: {cache['hit_rate']:.0%} попаданий")
+        lines.append(f"Очереди: запись {writes.depth}, исходящие {outbox.depth}")
+        await update.message.reply_text("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Metrics command failed: {e}")
+
+def build_application(token, request=None, get_updates_request=None, shared_dedup=False):
+    builder = Application.builder().token(token) \
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)) \
+        .persistence(SqlitePersistence(db, writes))
+    if request is not None:
+        builder = builder.request(request)
+    if get_updates_request is not None:
+        builder = builder.get_updates_request(get_updates_request)
+    application = builder.build()
+
+    # Дубликаты отсекаются раньше всех остальных обработчиков; через БД —
+    # только в кластере, одному процессу хватает памяти
+    deduplicator = UpdateDeduplicator(writes) if shared_dedup else RecentUpdateFilter()
+    application.add_handler(TypeHandler(Update, deduplicator), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("buy_uc", buy_uc))
+    application.add_handler(CommandHandler("promo", promo))
+    application.add_handler(CommandHandler("promo_set", promo_set))
+    application.add_handler(CommandHandler("promo_off", promo_off))
+    application.add_handler(CommandHandler("promos", promos_command))
+    application.add_handler(CommandHandler("referrals", referrals_command))
+    application.add_handler(CommandHandler("top_referrers", top_referrers_command))
+    application.add_handler(CommandHandler("bonus_audit", bonus_audit))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("bonuses", bonuses))
+    application.add_handler(CommandHandler("custom", custom_uc))
+    application.add_handler(CommandHandler("referral", referral))
+    application.add_handler(CommandHandler("language", language))
+    application.add_handler(CommandHandler("admin", admin))
+    application.add_handler(CommandHandler("rebuild_stats", rebuild_stats))
+    application.add_handler(CommandHandler("archive", archive_command))
+    application.add_handler(CommandHandler("complete", complete_command))
+    application.add_handler(CommandHandler("orders", orders_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CallbackQueryHandler(button_callback, pattern=f"^({catalog.callback_pattern}|enter_id|pay)$"))
+    application.add_handler(CallbackQueryHandler(set_language, pattern="^lang_"))
+    application.add_handler(CallbackQueryHandler(history_callback, pattern=r"^history:(older|newer):\d+:\d+$"))
+    application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, dispatch_text))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_screenshot))
+
+    register_metrics(application)
+    return application
+
 async def main():
+    token = os.environ.get("TOKEN")
+    if not token:
+        logger.error("No TOKEN environment variable set")
+        raise ValueError("No TOKEN environment variable set")
+
+    # /healthz доступен сразу и отвечает 503, пока вебхук не запущен
+    metrics_server = MetricsServer(host=METRICS_HOST, port=METRICS_PORT)
     try:
-        token = os.environ.get("TOKEN")
-        if not token:
-            logger.error("No TOKEN environment variable set")
-            raise ValueError("No TOKEN environment variable set")
-
-        application = Application.builder().token(token).build()
-
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("buy_uc", buy_uc))
-        application.add_handler(CommandHandler("promo", promo))
-        application.add_handler(CommandHandler("history", history))
-        application.add_handler(CommandHandler("bonuses", bonuses))
-        application.add_handler(CommandHandler("custom", custom_uc))
-        application.add_handler(CommandHandler("referral", referral))
-        application.add_handler(CommandHandler("language", language))
-        application.add_handler(CommandHandler("admin", admin))
-        application.add_handler(CallbackQueryHandler(button_callback, pattern="^(60uc|325uc|660uc|1800uc|3850uc|8100uc|enter_id|pay)$"))
-        application.add_handler(CallbackQueryHandler(set_language, pattern="^lang_"))
-        application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r'^\d{8,12}$'), handle_player_id))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_promo))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_uc))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_ban))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, simple_chatbot))
-        application.add_handler(MessageHandler(filters.PHOTO, handle_screenshot))
+        await metrics_server.start()
+        await asyncio.get_running_loop().run_in_executor(None, init)
+        application = build_application(token)
 
         logger.info("Starting webhook")
         await application.initialize()
         await application.start()
+        outbox.start(application.bot, digest_chat=ADMIN_ID, digest_interval=ADMIN_DIGEST_INTERVAL)
+        reminder_scheduler.start()
+        bonus_compactor.start()
+        order_archiver.start()
+        await broadcaster.resume_pending(application.bot)
         await application.updater.start_webhook(
             listen="0.0.0.0",
             port=8443,
             url_path="/webhook",
             webhook_url="https://topup-uc-bot.onrender.com/webhook"
         )
+        metrics_server.ready = True
         logger.info("Webhook started successfully")
     except Exception as e:
         logger.error(f"Failed to start application: {e}")
         raise
 
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down")
+    metrics_server.ready = False
+    await application.updater.stop()
+    # Сначала дорабатывают обработчики, затем очередь отправки разбирает их ответы
+    await application.stop()
+    await reminder_scheduler.stop()
+    await bonus_compactor.stop()
+    await order_archiver.stop()
+    await broadcaster.stop()
+    await outbox.stop()
+    screenshot_checker.close()
+    await application.shutdown()
+    await metrics_server.stop()
+    db.close()
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Рассылка берёт токены из общего лимита очереди исходящих (outbox) и
+# дополнительно не быстрее BROADCAST_RATE, чтобы ответам пользователям
+# оставалась часть общего лимита
+BROADCAST_RATE = 15
+BROADCAST_CONCURRENCY = 10
+BROADCAST_PAGE = 200
+MAX_ATTEMPTS = 5
+STOP_CALLBACK = 'admin_broadcast_stop'
+RESUME_CALLBACK = 'admin_broadcast_resume'
+
+RECIPIENTS_SQL = (
+    "FROM users u WHERE NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id) "
+    "AND NOT EXISTS (SELECT 1 FROM unreachable_users r WHERE r.user_id = u.user_id)"
+)
+
+
+def create_broadcast(conn, text, chat_id, now=None):
+    total = conn.execute("SELECT COUNT(*) " + RECIPIENTS_SQL).fetchone()[0]
+    now = int(now or time.time())
+    return conn.execute(
+        "INSERT INTO broadcasts (text, status, total, progress_chat_id, created_at, updated_at) "
+        "VALUES (?, 'running', ?, ?, ?, ?)",
+        (text, total, chat_id, now, now)
+    ).lastrowid
+
+
+def load_broadcast(conn, broadcast_id):
+    row = conn.execute(
+        "SELECT broadcast_id, text, status, cursor_user_id, total, sent, failed, blocked, "
+        "progress_chat_id, progress_message_id, created_at FROM broadcasts WHERE broadcast_id = ?",
+        (broadcast_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    keys = ('broadcast_id', 'text', 'status', 'cursor', 'total', 'sent', 'failed', 'blocked',
+            'chat_id', 'message_id', 'created_at')
+    return dict(zip(keys, row))
+
+
+# Следующая страница получателей по ключу user_id, от курсора, вместе
+# с текущим статусом: пауза могла быть поставлена из другого процесса
+def next_recipients(conn, broadcast_id, cursor, limit=BROADCAST_PAGE):
+    status = conn.execute("SELECT status FROM broadcasts WHERE broadcast_id = ?", (broadcast_id,)).fetchone()[0]
+    if status != 'running':
+        return status, []
+    return status, [row[0] for row in conn.execute(
+        "SELECT u.user_id " + RECIPIENTS_SQL + " AND u.user_id > ? ORDER BY u.user_id LIMIT ?",
+        (cursor, limit)
+    )]
+
+
+# Контрольная точка: курсор и счётчики страницы фиксируются одной транзакцией,
+# после сбоя рассылка продолжается со следующей страницы
+def save_checkpoint(conn, broadcast_id, cursor, sent, failed, blocked_ids, now=None):
+    now = int(now or time.time())
+    conn.executemany(
+        "INSERT OR IGNORE INTO unreachable_users (user_id, since) VALUES (?, ?)",
+        [(user_id, now) for user_id in blocked_ids]
+    )
+    conn.execute(
+        "UPDATE broadcasts SET cursor_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, "
+        "updated_at = ? WHERE broadcast_id = ?",
+        (cursor, sent, failed, len(blocked_ids), now, broadcast_id)
+    )
+
+
+def set_status(conn, broadcast_id, status, now=None):
+    conn.execute(
+        "UPDATE broadcasts SET status = ?, updated_at = ? WHERE broadcast_id = ?",
+        (status, int(now or time.time()), broadcast_id)
+    )
+
+
+def set_progress_message(conn, broadcast_id, message_id):
+    conn.execute("UPDATE broadcasts SET progress_message_id = ? WHERE broadcast_id = ?", (message_id, broadcast_id))
+
+
+def running_broadcasts(conn):
+    return [row[0] for row in conn.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'")]
+
+
+def format_progress(state, rate=None):
+    done = state['sent'] + state['failed'] + state['blocked']
+    percent = done * 100 // state['total'] if state['total'] else 100
+    status = {'running': "идёт", 'paused': "приостановлена", 'done': "завершена"}.get(state['status'], state['status'])
+    text = (f"Рассылка #{state['broadcast_id']} ({status}): {done} из {state['total']} ({percent}%)\n"
+            f"Доставлено: {state['sent']}, заблокировали бота: {state['blocked']}, ошибок: {state['failed']}")
+    if rate:
+        text += f"\nСкорость: {rate:.1f} сообщ./с"
+    return text
+
+
+def progress_keyboard(state):
+    if state['status'] == 'running':
+        button = InlineKeyboardButton("Приостановить", callback_data=f"{STOP_CALLBACK}:{state['broadcast_id']}")
+    elif state['status'] == 'paused':
+        button = InlineKeyboardButton("Продолжить", callback_data=f"{RESUME_CALLBACK}:{state['broadcast_id']}")
+    else:
+        return None
+    return InlineKeyboardMarkup([[button]])
+
+
+# Рассылка всем пользователям: получатели читаются страницами по ключу,
+# отправка идёт параллельно, но не быстрее rate сообщений в секунду.
+# RetryAfter приостанавливает всю рассылку, заблокировавшие бота
+# пользователи запоминаются и больше не получают рассылок.
+class Broadcaster:
+    def __init__(self, database, outbox, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 page=BROADCAST_PAGE):
+        self.db = database
+        self.outbox = outbox
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.page = page
+        self.bot = None
+        self._tasks = {}
+        self._paused_until = 0.0
+
+    @property
+    def active(self):
+        return len(self._tasks)
+
+    def start(self, bot, broadcast_id):
+        self.bot = bot
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    # Незавершённые после перезапуска рассылки продолжаются с контрольной точки
+    async def resume_pending(self, bot):
+        for broadcast_id in await self.db.read(running_broadcasts):
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            self.start(bot, broadcast_id)
+
+    # Пауза срабатывает на границе страницы, поэтому ничего не отправляется дважды.
+    # Если рассылка идёт не в этом процессе (или её задача уже завершилась),
+    # кнопку «Продолжить» показываем сразу.
+    async def pause(self, bot, broadcast_id):
+        self.bot = bot
+        await self.db.write(lambda conn: set_status(conn, broadcast_id, 'paused'))
+        if broadcast_id not in self._tasks:
+            state = await self.db.read(lambda conn: load_broadcast(conn, broadcast_id))
+            if state is not None:
+                await self._show_progress(state)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send_one(self, user_id, text):
+        attempts = 0
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            # Общий с outbox лимит: вместе они не превышают лимит Telegram
+            await self.outbox.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                self._paused_until = time.monotonic() + e.retry_after
+                logger.warning(f"Broadcast hit flood limit, pausing for {e.retry_after}s")
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'blocked'
+                logger.error(f"Broadcast to {user_id} failed: {e}")
+                return 'failed'
+            except NetworkError as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.error(f"Broadcast gave up on {user_id}: {e}")
+                    return 'failed'
+                logger.warning(f"Broadcast to {user_id} failed ({e}), attempt {attempts}")
+                await asyncio.sleep(min(2 ** attempts, 30))
+
+    async def _show_progress(self, state, rate=None):
+        if not state['chat_id']:
+            return
+        text = format_progress(state, rate)
+        keyboard = progress_keyboard(state)
+        try:
+            if state['message_id']:
+                await self.bot.edit_message_text(text, chat_id=state['chat_id'], message_id=state['message_id'],
+                                                 reply_markup=keyboard)
+            else:
+                message = await self.bot.send_message(state['chat_id'], text, reply_markup=keyboard)
+                state['message_id'] = message.message_id
+                await self.db.write(lambda conn: set_progress_message(conn, state['broadcast_id'], message.message_id))
+        except TelegramError as e:
+            # «message is not modified», удалённое сообщение или сбой сети
+            # не должны останавливать рассылку
+            logger.debug(f"Broadcast progress not updated: {e}")
+
+    async def _run(self, broadcast_id):
+        state = await self.db.read(lambda conn: load_broadcast(conn, broadcast_id))
+        if state is None or state['status'] not in ('running', 'paused'):
+            return
+        if state['status'] == 'paused':
+            await self.db.write(lambda conn: set_status(conn, broadcast_id, 'running'))
+            state['status'] = 'running'
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with limit:
+                return user_id, await self._send_one(user_id, state['text'])
+
+        started, delivered = time.monotonic(), 0
+        await self._show_progress(state)
+        try:
+            while True:
+                status, recipients = await self.db.read(
+                    lambda conn: next_recipients(conn, broadcast_id, state['cursor'], self.page)
+                )
+                if status != 'running':
+                    state['status'] = status
+                    await self._show_progress(state)
+                    logger.info(f"Broadcast {broadcast_id} {status} at user {state['cursor']}")
+                    return
+                if not recipients:
+                    break
+                results = await asyncio.gather(*(send(user_id) for user_id in recipients))
+                sent = sum(1 for _, result in results if result == 'sent')
+                failed = sum(1 for _, result in results if result == 'failed')
+                blocked = [user_id for user_id, result in results if result == 'blocked']
+                cursor = recipients[-1]
+                await self.db.write(lambda conn: save_checkpoint(conn, broadcast_id, cursor, sent, failed, blocked))
+                state.update(cursor=cursor, sent=state['sent'] + sent, failed=state['failed'] + failed,
+                             blocked=state['blocked'] + len(blocked))
+                delivered += len(recipients)
+                await self._show_progress(state, delivered / (time.monotonic() - started))
+            await self.db.write(lambda conn: set_status(conn, broadcast_id, 'done'))
+            state['status'] = 'done'
+            await self._show_progress(state)
+            logger.info(f"Broadcast {broadcast_id} finished: {state['sent']} sent, {state['blocked']} blocked, "
+                        f"{state['failed']} failed")
+        except asyncio.CancelledError:
+            # Остановка процесса: статус остаётся running, и после перезапуска
+            # незафиксированная страница отправляется заново
+            raise
+        except Exception as e:
+            # Рассылка ставится на паузу, чтобы админ мог продолжить её кнопкой
+            logger.error(f"Broadcast {broadcast_id} stopped: {e}")
+            try:
+                await self.db.write(lambda conn: set_status(conn, broadcast_id, 'paused'))
+                state['status'] = 'paused'
+                await self._show_progress(state)
+            except Exception as e:
+                logger.error(f"Broadcast {broadcast_id} could not be paused: {e}")
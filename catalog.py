@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+from functools import reduce
+from math import gcd
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+PRICES_PATH = '/opt/data/prices.json'
+CALLBACK_SUFFIX = 'uc'
+# Верхняя граница калькулятора /custom: до неё таблица покрытия строится целиком
+MAX_CUSTOM_UC = 100000
+BASIS_POINTS = 10000
+
+
+def parse_price(label):
+    # "90.06 ₽" -> 9006 (копейки)
+    match = re.search(r'\d+(?:[.,]\d{1,2})?', str(label))
+    if not match:
+        raise ValueError(f"Cannot parse price {label!r}")
+    rubles, _, kopecks = match.group(0).replace(',', '.').partition('.')
+    return int(rubles) * 100 + int(kopecks.ljust(2, '0'))
+
+
+def format_price(kopecks):
+    return f"{kopecks // 100}.{kopecks % 100:02d} ₽"
+
+
+# Скидки хранятся в долях (0.1), считаем в базисных пунктах (1000)
+def to_basis_points(discount):
+    return round(discount * BASIS_POINTS)
+
+
+def format_percent(basis_points):
+    return f"{basis_points / 100:g}%"
+
+
+def apply_discount(kopecks, basis_points):
+    # Округление до копейки половиной вверх, без float
+    return (kopecks * (BASIS_POINTS - basis_points) + BASIS_POINTS // 2) // BASIS_POINTS
+
+
+@dataclass(frozen=True)
+class Quote:
+    requested: int
+    covered: int
+    kopecks: int
+    packages: tuple  # ((uc, количество), ...) от крупных к мелким
+
+
+# Каталог цен: файл перечитывается только при изменении mtime,
+# цены хранятся в копейках, клавиатуры собираются один раз на версию.
+class PriceCatalog:
+    def __init__(self, path=PRICES_PATH, defaults=None, check_interval=1.0):
+        self.path = path
+        self.defaults = defaults or {}
+        self.check_interval = check_interval
+        self.version = 0
+        self._mtime = None
+        self._checked_at = 0.0
+        self._labels = {}
+        self._kopecks = {}
+        self._keyboards = {}
+        self._discounts = {}
+        self._quotes = {}
+        self._cover = None
+        self._apply(self.defaults)
+
+    def _apply(self, raw):
+        kopecks = {str(uc): parse_price(label) for uc, label in raw.items()}
+        self._kopecks = dict(sorted(kopecks.items(), key=lambda item: int(item[0])))
+        self._labels = {uc: format_price(kop) for uc, kop in self._kopecks.items()}
+        self._keyboards = {}
+        self._discounts = {}
+        self._quotes = {}
+        self._cover = None
+        self.version += 1
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._mtime is not None:
+                logger.error(f"Prices file {self.path} is unavailable: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self._apply(json.load(f))
+            self._mtime = mtime
+            logger.info(f"Price catalog loaded from {self.path} (version {self.version})")
+        except Exception as e:
+            logger.error(f"Failed to load {self.path}: {e}")
+
+    def labels(self):
+        self.refresh()
+        return self._labels
+
+    def packages(self):
+        self.refresh()
+        return list(self._kopecks)
+
+    def has(self, uc_amount):
+        self.refresh()
+        return uc_amount in self._kopecks
+
+    def price_kopecks(self, uc_amount):
+        self.refresh()
+        return self._kopecks.get(uc_amount)
+
+    def keyboard(self, lang):
+        self.refresh()
+        keyboard = self._keyboards.get(lang)
+        if keyboard is None:
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"{uc} UC: {label}", callback_data=f"{uc}{CALLBACK_SUFFIX}")]
+                for uc, label in self._labels.items()
+            ])
+            self._keyboards[lang] = keyboard
+        return keyboard
+
+    # Шаблон не перечисляет пакеты, поэтому новые цены работают без перезапуска
+    @property
+    def callback_pattern(self):
+        return rf"\d+{CALLBACK_SUFFIX}"
+
+    def package_from_callback(self, data):
+        if not data.endswith(CALLBACK_SUFFIX):
+            return None
+        uc_amount = data[:-len(CALLBACK_SUFFIX)]
+        return uc_amount if self.has(uc_amount) else None
+
+    # Цены всех пакетов со скидкой считаются один раз на версию каталога
+    def discount_table(self, basis_points):
+        self.refresh()
+        table = self._discounts.get(basis_points)
+        if table is None:
+            table = {uc: apply_discount(kop, basis_points) for uc, kop in self._kopecks.items()}
+            self._discounts[basis_points] = table
+        return table
+
+    # cost[u] — цена самого дешёвого набора пакетов не меньше чем на u * step UC:
+    # cost[u] = min(цена p + cost[u - размер p]). Все объёмы кратны НОД
+    # пакетов, поэтому таблица строится в единицах step и один раз на версию.
+    def _cover_table(self):
+        if self._cover is None:
+            sizes = [(int(uc), uc) for uc in self._kopecks]
+            step = reduce(gcd, (size for size, _ in sizes))
+            items = [(size // step, self._kopecks[uc], uc) for size, uc in sizes]
+            units = -(-MAX_CUSTOM_UC // step)
+            cost = [0] * (units + 1)
+            choice = [None] * (units + 1)
+            for u in range(1, units + 1):
+                best = None
+                for size, kop, uc in items:
+                    candidate = kop + cost[u - size if u > size else 0]
+                    if best is None or candidate < best:
+                        best, pick = candidate, (size, uc)
+                cost[u] = best
+                choice[u] = pick
+            self._cover = (step, cost, choice)
+        return self._cover
+
+    def quote(self, uc_amount, basis_points=0):
+        self.refresh()
+        if not self._kopecks or not 0 < uc_amount <= MAX_CUSTOM_UC:
+            return None
+        key = (uc_amount, basis_points)
+        cached = self._quotes.get(key)
+        if cached is not None:
+            return cached
+        step, _, choice = self._cover_table()
+        counts = {}
+        u = -(-uc_amount // step)
+        while u > 0:
+            size, uc = choice[u]
+            counts[uc] = counts.get(uc, 0) + 1
+            u -= size
+        prices = self.discount_table(basis_points) if basis_points else self._kopecks
+        packages = tuple(sorted(counts.items(), key=lambda item: -int(item[0])))
+        quote = Quote(
+            requested=uc_amount,
+            covered=sum(int(uc) * count for uc, count in packages),
+            kopecks=sum(prices[uc] * count for uc, count in packages),
+            packages=packages,
+        )
+        self._quotes[key] = quote
+        return quote
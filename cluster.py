@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+
+from telegram import Bot, Update
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Режим нескольких процессов: один приёмник вебхука раскладывает обновления
+# по рабочим процессам по user_id (порядок одного пользователя сохраняется),
+# общее состояние живёт в bot.db, повторные доставки отсекает processed_updates.
+#
+#   python cluster.py serve --workers 4
+#   python cluster.py serve --workers 4 --fake-bot --port 8080   # локальная проверка
+#   python cluster.py send --url http://127.0.0.1:8080/webhook --updates 1000 --redeliver 0.2
+
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "https://topup-uc-bot.onrender.com/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+# Бан и другие изменения из соседних процессов видны не позже, чем через TTL
+CLUSTER_PROFILE_TTL = 30
+
+UPDATE_KINDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request', 'channel_post', 'edited_channel_post',
+)
+
+
+def shard_key(data):
+    for kind in UPDATE_KINDS:
+        obj = data.get(kind)
+        if not isinstance(obj, dict):
+            continue
+        for field in ('from', 'user'):
+            if isinstance(obj.get(field), dict) and 'id' in obj[field]:
+                return obj[field]['id']
+        chat = obj.get('chat') or (obj.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return data.get('update_id', 0)
+
+
+def worker_main(index, workers, queue, fake_bot):
+    logging.basicConfig(format=f'%(asctime)s - worker{index} - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO, force=True)
+    # Останавливает рабочих только приёмник (через None в очереди)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, workers, queue, fake_bot))
+
+
+async def run_worker(index, workers, queue, fake_bot):
+    import bot
+    from metrics import MetricsServer
+    from outbox import TokenBucket, outbox
+    from profiles import profiles
+
+    request = updates_request = None
+    if fake_bot:
+        from bench import FakeRequest
+        request, updates_request = FakeRequest(), FakeRequest()
+    bot.init()
+    profiles.ttl = CLUSTER_PROFILE_TTL
+    application = bot.build_application(os.environ.get("TOKEN", "1:local"), request, updates_request,
+                                        shared_dedup=True)
+    await application.initialize()
+    await application.start()
+    # Общий лимит Telegram делится между процессами
+    outbox.global_bucket = TokenBucket(outbox.global_bucket.rate / workers)
+    outbox.start(application.bot, digest_chat=bot.ADMIN_ID, digest_interval=bot.ADMIN_DIGEST_INTERVAL)
+    if index == 0:
+        bot.reminder_scheduler.start()
+        bot.bonus_compactor.start()
+        bot.order_archiver.start()
+        await bot.broadcaster.resume_pending(application.bot)
+    metrics_server = MetricsServer(port=bot.METRICS_PORT + index)
+    await metrics_server.start()
+    logger.info(f"Worker {index} ready")
+
+    loop = asyncio.get_running_loop()
+    while True:
+        raw = await loop.run_in_executor(None, queue.get)
+        if raw is None:
+            break
+        try:
+            await application.update_queue.put(Update.de_json(json.loads(raw), application.bot))
+        except Exception as e:
+            logger.error(f"Worker {index} rejected update: {e}")
+
+    logger.info(f"Worker {index} stopping")
+    await metrics_server.stop()
+    await application.stop()
+    await bot.reminder_scheduler.stop()
+    await bot.bonus_compactor.stop()
+    await bot.order_archiver.stop()
+    await bot.broadcaster.stop()
+    await outbox.stop()
+    bot.screenshot_checker.close()
+    await application.shutdown()
+    if fake_bot:
+        logger.info(f"Worker {index} Bot API calls: {dict(request.calls)}")
+
+
+class WebhookReceiver:
+    def __init__(self, queues, host='0.0.0.0', port=8443, path='/webhook', secret=''):
+        self.queues = queues
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.received = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Webhook receiver listening on {self.host}:{self.port}{self.path} "
+                    f"for {len(self.queues)} workers")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _respond(self, writer, status, reason):
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: 0\r\n\r\n".encode())
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method, path = request_line.decode('latin-1').split()[:2]
+                if method != 'POST' or path != self.path:
+                    await self._respond(writer, 404, 'Not Found')
+                elif self.secret and headers.get(SECRET_HEADER) != self.secret:
+                    await self._respond(writer, 403, 'Forbidden')
+                else:
+                    data = json.loads(body)
+                    self.queues[shard_key(data) % len(self.queues)].put(body.decode())
+                    self.received += 1
+                    await self._respond(writer, 200, 'OK')
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Webhook request failed: {e}")
+            await self._respond(writer, 400, 'Bad Request')
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    # Миграции выполняются один раз в родительском процессе до запуска рабочих
+    import bot
+    bot.init()
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(args.workers)]
+    processes = [context.Process(target=worker_main, args=(i, args.workers, queue, args.fake_bot), daemon=True)
+                 for i, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    receiver = WebhookReceiver(queues, args.host, args.port, args.path, WEBHOOK_SECRET)
+    await receiver.start()
+    if not args.fake_bot:
+        async with Bot(os.environ["TOKEN"]) as telegram_bot:
+            await telegram_bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+        logger.info(f"Webhook set to {WEBHOOK_URL}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info(f"Shutting down after {receiver.received} updates")
+    await receiver.stop()
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        await loop.run_in_executor(None, process.join, 30)
+
+
+# Локальная замена Telegram: отправляет синтетические обновления на приёмник,
+# часть из них — повторно, как при повторной доставке вебхука
+async def send(args):
+    import httpx
+    from bench import UpdateFactory
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    factory = UpdateFactory()
+    headers = {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    sent = redelivered = 0
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def post(data):
+            response = await client.post(args.url, json=data, headers=headers)
+            response.raise_for_status()
+
+        for _ in range(args.updates):
+            user_id = 100000 + random.randrange(args.users)
+            data = random.choice([
+                factory.message(user_id, '/start'),
+                factory.message(user_id, '/buy_uc'),
+                factory.callback(user_id, '60uc'),
+                factory.message(user_id, '/history'),
+            ])
+            await post(data)
+            sent += 1
+            if random.random() < args.redeliver:
+                await post(data)
+                redelivered += 1
+    print(f"Sent {sent} updates, {redelivered} redelivered")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-process webhook mode")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    serve_parser.add_argument('--host', default='0.0.0.0')
+    serve_parser.add_argument('--port', type=int, default=8443)
+    serve_parser.add_argument('--path', default='/webhook')
+    serve_parser.add_argument('--fake-bot', action='store_true', help="record Bot API calls instead of sending")
+    send_parser = commands.add_parser('send')
+    send_parser.add_argument('--url', default='http://127.0.0.1:8443/webhook')
+    send_parser.add_argument('--users', type=int, default=50)
+    send_parser.add_argument('--updates', type=int, default=200)
+    send_parser.add_argument('--redeliver', type=float, default=0.1, help="share of updates delivered twice")
+    args = parser.parse_args()
+    asyncio.run(serve(args) if args.command == 'serve' else send(args))
+
+
+if __name__ == '__main__':
+    main()
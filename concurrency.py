@@ -0,0 +1,57 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_key(update):
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, 'effective_chat', None)
+    return chat.id if chat is not None else None
+
+
+# Обновления разных пользователей обрабатываются параллельно (не больше
+# max_concurrent_updates одновременно), а обновления одного пользователя —
+# строго по очереди. Блокировка пользователя берётся до общего семафора,
+# чтобы ожидающие обновления не занимали слоты обработчиков.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    @asynccontextmanager
+    async def _serialized(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @property
+    def active_keys(self):
+        return len(self._locks)
+
+    async def process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        async with self._serialized(key):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
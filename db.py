@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = '/opt/data/bot.db'
+ARCHIVE_NAME = 'archive.db'
+
+
+# Общий слой доступа к SQLite: одно соединение-писатель и пул читателей.
+# Все запросы выполняются в потоках, чтобы не блокировать цикл событий.
+class Database:
+    def __init__(self, path=DB_PATH, readers=4):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._reader_pool = None
+        self._write_executor = None
+        self._read_executor = None
+        # observer(kind, seconds) вызывается после каждого обращения к БД
+        self.observer = None
+
+    @property
+    def is_open(self):
+        return self._writer is not None
+
+    # Архив старых заказов лежит рядом с основной базой
+    @property
+    def archive_path(self):
+        return os.path.join(os.path.dirname(self.path), ARCHIVE_NAME)
+
+    def _connect(self, readonly=False):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        if readonly:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def open(self, path=None):
+        if self.is_open:
+            return self
+        if path:
+            self.path = path
+        self._writer = self._connect()
+        mode = self._writer.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if mode.lower() != 'wal':
+            logger.warning(f"WAL mode is not available for {self.path}, using {mode}")
+        self._reader_pool = queue.Queue()
+        for _ in range(self.readers):
+            self._reader_pool.put(self._connect(readonly=True))
+        # Писатель один, поэтому запись сериализуется одним потоком
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._read_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='db-reader')
+        logger.info(f"Database opened at {self.path} with {self.readers} readers")
+        return self
+
+    def close(self):
+        if not self.is_open:
+            return
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        while not self._reader_pool.empty():
+            self._reader_pool.get_nowait().close()
+        self._writer.close()
+        self._writer = None
+        self._reader_pool = None
+        logger.info(f"Database at {self.path} closed")
+
+    # Синхронные варианты для кода, который уже работает вне цикла событий
+    def write_sync(self, fn):
+        started = time.perf_counter()
+        try:
+            result = fn(self._writer)
+            self._writer.commit()
+            return result
+        except Exception:
+            self._writer.rollback()
+            raise
+        finally:
+            if self.observer:
+                self.observer('write', time.perf_counter() - started)
+
+    def read_sync(self, fn):
+        conn = self._reader_pool.get()
+        started = time.perf_counter()
+        try:
+            return fn(conn)
+        finally:
+            self._reader_pool.put(conn)
+            if self.observer:
+                self.observer('read', time.perf_counter() - started)
+
+    async def write(self, fn):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._write_executor, self.write_sync, fn)
+
+    async def read(self, fn):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_executor, self.read_sync, fn)
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+
+db = Database()
+
+
+# Очередь отложенной записи: операции от разных обновлений собираются
+# и фиксируются одной транзакцией (один fsync на пачку). submit()
+# возвращает управление только после коммита, так что подтверждение
+# пользователю уходит уже после надёжной записи.
+class WriteQueue:
+    def __init__(self, database, max_delay=0.005, max_batch=200):
+        self.db = database
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.batches = 0
+        self.operations = 0
+        self._pending = []
+        self._timer = None
+        self._flushes = set()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    async def submit(self, fn):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((fn, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    @staticmethod
+    def _apply(conn, batch):
+        # Каждая операция в своей точке сохранения: ошибка одной
+        # не откатывает остальные операции пачки
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        results = []
+        for fn, _ in batch:
+            conn.execute("SAVEPOINT write_op")
+            try:
+                results.append((True, fn(conn)))
+                conn.execute("RELEASE write_op")
+            except Exception as e:
+                conn.execute("ROLLBACK TO write_op")
+                conn.execute("RELEASE write_op")
+                results.append((False, e))
+        return results
+
+    async def _flush(self, batch):
+        try:
+            results = await self.db.write(lambda conn: self._apply(conn, batch))
+        except Exception as e:
+            logger.error(f"Write batch of {len(batch)} operations failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.operations += len(batch)
+        for (_, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def flush(self):
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+writes = WriteQueue(db)
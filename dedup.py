@@ -0,0 +1,61 @@
+import logging
+import time
+from collections import deque
+
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+DEDUP_TTL = 86400
+PRUNE_EVERY = 1000
+RECENT_UPDATES = 10000
+
+
+# Повторная доставка вебхука в одном процессе: последние update_id держатся
+# в памяти, без обращения к БД перед каждым обработчиком
+class RecentUpdateFilter:
+    def __init__(self, size=RECENT_UPDATES):
+        self.duplicates = 0
+        self._ids = set()
+        self._order = deque(maxlen=size)
+
+    async def __call__(self, update, context):
+        if update.update_id in self._ids:
+            self.duplicates += 1
+            logger.info(f"Skipping duplicate update {update.update_id}")
+            raise ApplicationHandlerStop
+        if len(self._order) == self._order.maxlen:
+            self._ids.discard(self._order[0])
+        self._order.append(update.update_id)
+        self._ids.add(update.update_id)
+
+
+# Повторная доставка вебхука приходит с тем же update_id; первая вставка
+# в processed_updates «выигрывает», остальные копии отбрасываются.
+# Нужен кластеру: копии одного обновления могут попасть в разные процессы.
+class UpdateDeduplicator:
+    def __init__(self, write_queue, ttl=DEDUP_TTL, prune_every=PRUNE_EVERY):
+        self.writes = write_queue
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.duplicates = 0
+        self._seen = 0
+
+    def _claim(self, conn, update_id, now, prune):
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+            (update_id, now)
+        ).rowcount
+        if prune:
+            conn.execute("DELETE FROM processed_updates WHERE received_at < ?", (now - self.ttl,))
+        return inserted
+
+    async def __call__(self, update, context):
+        self._seen += 1
+        prune = self._seen % self.prune_every == 0
+        now = int(time.time())
+        inserted = await self.writes.submit(lambda conn: self._claim(conn, update.update_id, now, prune))
+        if not inserted:
+            self.duplicates += 1
+            logger.info(f"Skipping duplicate update {update.update_id}")
+            raise ApplicationHandlerStop
@@ -0,0 +1,104 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from archive import union_sql
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK = 2000
+EXPORT_FORMATS = ('csv', 'jsonl')
+ARCHIVE_ARG = 'archive'
+# Лимит Bot API на отправку файлов
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+COLUMNS = ('order_id', 'user_id', 'uc_amount', 'price', 'amount_kop', 'player_id', 'status', 'created_at')
+
+
+# Пачка заказов по ключу (created_at, order_id) в полуинтервале [since, until).
+# С фильтром статуса сканируется индекс (status, created_at), без него — (created_at, order_id);
+# с архивом то же самое делается в обеих таблицах и результаты сливаются.
+def fetch_chunk(conn, since, until, status=None, cursor=None, limit=EXPORT_CHUNK, include_archive=False):
+    where, params = ["created_at >= ?", "created_at < ?"], [since, until]
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if cursor:
+        where.append("(created_at, order_id) > (?, ?)")
+        params.extend(cursor)
+    return conn.execute(
+        union_sql(', '.join(COLUMNS), ' AND '.join(where), "ORDER BY created_at, order_id LIMIT ?", include_archive),
+        params * (2 if include_archive else 1) + [limit]
+    ).fetchall()
+
+
+# Аргументы /export: до двух дат ГГГГ-ММ-ДД (включительно), статус, формат
+# и archive (добавить архивные заказы) в любом порядке.
+# Возвращает (since, until, status, fmt, include_archive, имя файла).
+def parse_export_args(args, statuses):
+    dates, status, fmt, include_archive = [], None, 'csv', False
+    for arg in args:
+        if arg in statuses:
+            status = arg
+        elif arg.lower() in EXPORT_FORMATS:
+            fmt = arg.lower()
+        elif arg.lower() == ARCHIVE_ARG:
+            include_archive = True
+        else:
+            dates.append(datetime.strptime(arg, '%Y-%m-%d'))
+    if len(dates) > 2:
+        raise ValueError("too many dates")
+    since = int(dates[0].timestamp()) if dates else 0
+    until = int((dates[-1] + timedelta(days=1)).timestamp()) if len(dates) == 2 else int(time.time()) + 1
+    if until <= since:
+        raise ValueError("empty range")
+    name = "orders" + "".join(f"_{d:%Y%m%d}" for d in dates) + (f"_{status}" if status else "") + \
+        ("_archive" if include_archive else "") + f".{fmt}.gz"
+    return since, until, status, fmt, include_archive, name
+
+
+def _csv_writer(f):
+    writer = csv.writer(f)
+    writer.writerow(COLUMNS + ('created',))
+    return lambda row: writer.writerow(row + (datetime.fromtimestamp(row[-1]).isoformat(sep=' '),))
+
+
+def _jsonl_writer(f):
+    def write(row):
+        record = dict(zip(COLUMNS, row))
+        record['created'] = datetime.fromtimestamp(row[-1]).isoformat(sep=' ')
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return write
+
+
+# Потоковая выгрузка в сжатый временный файл. Выполняется в потоке вне цикла
+# событий; соединение-читатель берётся только на время одной пачки, в памяти
+# держится не больше одной пачки. Возвращает (путь, число строк).
+def export_orders(database, since, until, status=None, fmt='csv', chunk=EXPORT_CHUNK, directory=None,
+                  include_archive=False):
+    fd, path = tempfile.mkstemp(prefix='orders-', suffix=f'.{fmt}.gz', dir=directory)
+    os.close(fd)
+    count = 0
+    try:
+        with gzip.open(path, 'wt', compresslevel=6, encoding='utf-8', newline='') as f:
+            write = _csv_writer(f) if fmt == 'csv' else _jsonl_writer(f)
+            cursor = None
+            while True:
+                rows = database.read_sync(
+                    lambda conn: fetch_chunk(conn, since, until, status, cursor, chunk, include_archive)
+                )
+                for row in rows:
+                    write(row)
+                count += len(rows)
+                if len(rows) < chunk:
+                    break
+                cursor = (rows[-1][7], rows[-1][0])
+    except Exception:
+        os.remove(path)
+        raise
+    logger.info(f"Exported {count} orders to {path}")
+    return path, count
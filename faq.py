@@ -0,0 +1,154 @@
+import json
+import logging
+import math
+import os
+import re
+import time
+from difflib import SequenceMatcher
+
+logger = logging.getLogger(__name__)
+
+FAQ_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'faq.json')
+# Доля веса слов вопроса, которая должна встретиться в сообщении; частые
+# слова («как», «мой», «to») весят меньше редких («заказ», «оплатить»)
+MIN_COVERAGE = 0.6
+# Порог похожести слова с опечаткой на слово из словаря
+MIN_SIMILARITY = 0.75
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+
+def trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Индекс одного языка: нормализованная фраза -> ответ, слово -> вопросы,
+# триграмма -> слова словаря (кандидаты для исправления опечаток)
+class FaqIndex:
+    def __init__(self, entries, fallback):
+        self.fallback = fallback
+        self.answers = []
+        self.questions = []
+        self.exact = {}
+        self.postings = {}
+        self.trigrams = {}
+        self._corrections = {}
+        for entry in entries:
+            answer_id = len(self.answers)
+            self.answers.append(entry['answer'])
+            for question in entry['questions']:
+                tokens = tuple(tokenize(question))
+                if not tokens:
+                    continue
+                self.exact.setdefault(' '.join(tokens), answer_id)
+                question_id = len(self.questions)
+                self.questions.append((frozenset(tokens), answer_id))
+                for token in set(tokens):
+                    self.postings.setdefault(token, []).append(question_id)
+        total = len(self.questions)
+        self.weights = {token: math.log(1 + total / len(ids)) for token, ids in self.postings.items()}
+        self.question_weights = [sum(self.weights[token] for token in tokens) for tokens, _ in self.questions]
+        for token in self.postings:
+            for gram in trigrams(token):
+                self.trigrams.setdefault(gram, set()).add(token)
+
+    # Ближайшее слово словаря: кандидаты по общим триграммам, затем сравнение строк
+    def correct(self, token):
+        if token in self._corrections:
+            return self._corrections[token]
+        candidates = {}
+        for gram in trigrams(token):
+            for word in self.trigrams.get(gram, ()):
+                candidates[word] = candidates.get(word, 0) + 1
+        best, best_score = None, MIN_SIMILARITY
+        for word, _ in sorted(candidates.items(), key=lambda item: -item[1])[:20]:
+            score = SequenceMatcher(None, token, word).ratio()
+            if score >= best_score:
+                best, best_score = word, score
+        if len(self._corrections) > 10000:
+            self._corrections.clear()
+        self._corrections[token] = best
+        return best
+
+    def match(self, text, fuzzy=True):
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        answer_id = self.exact.get(' '.join(tokens))
+        if answer_id is not None:
+            return self.answers[answer_id]
+        words = set()
+        for token in tokens:
+            if token in self.postings:
+                words.add(token)
+            elif fuzzy and len(token) > 3:
+                corrected = self.correct(token)
+                if corrected:
+                    words.add(corrected)
+        hits = {}
+        for word in words:
+            for question_id in self.postings.get(word, ()):
+                hits[question_id] = hits.get(question_id, 0) + self.weights[word]
+        best, best_key = None, None
+        for question_id, weight in hits.items():
+            coverage = weight / self.question_weights[question_id]
+            if coverage < MIN_COVERAGE:
+                continue
+            # При равном покрытии выигрывает более длинный (конкретный) вопрос
+            answer_id = self.questions[question_id][1]
+            key = (coverage, weight)
+            if best_key is None or key > best_key:
+                best, best_key = answer_id, key
+        return self.answers[best] if best is not None else None
+
+
+# Ответы на частые вопросы из faq.json. Индексы строятся один раз и
+# перестраиваются только при изменении mtime файла (как каталог цен).
+class FaqEngine:
+    def __init__(self, path=FAQ_PATH, check_interval=1.0, fuzzy=True):
+        self.path = path
+        self.check_interval = check_interval
+        self.fuzzy = fuzzy
+        self.version = 0
+        self._mtime = None
+        self._checked_at = 0.0
+        self._indexes = {}
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._mtime is not None:
+                logger.error(f"FAQ file {self.path} is unavailable: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+            self._indexes = {
+                lang: FaqIndex(section.get('entries', []), section.get('fallback'))
+                for lang, section in raw.items()
+            }
+            self._mtime = mtime
+            self.version += 1
+            logger.info(f"FAQ loaded from {self.path} (version {self.version})")
+        except Exception as e:
+            logger.error(f"Failed to load {self.path}: {e}")
+
+    # Ответ на сообщение или запасная фраза языка, если совпадений нет
+    def answer(self, text, lang):
+        self.refresh()
+        index = self._indexes.get(lang) or self._indexes.get('ru')
+        if index is None:
+            return None
+        return index.match(text, self.fuzzy) or index.fallback
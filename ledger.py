@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+COMPACT_INTERVAL = 300
+COMPACT_BATCH = 50000
+REFERRAL_DEPTH = 5
+
+# Бонусы ведутся только журналом bonus_ledger (записи не меняются и не удаляются).
+# users.bonuses — снимок журнала до bonus_compaction.through_entry_id;
+# текущий баланс = снимок + записи после этой границы.
+PENDING_SUM_SQL = (
+    "SELECT COALESCE(SUM(l.delta), 0) FROM bonus_ledger l "
+    "WHERE l.user_id = {user} AND l.entry_id > (SELECT through_entry_id FROM bonus_compaction)"
+)
+
+
+# Начисление (или списание при отрицательном delta). Записи, привязанные
+# к заказу, уникальны по (order_id, reason, user_id), поэтому повторное
+# нажатие кнопки не начисляет бонус второй раз.
+def credit(conn, user_id, delta, reason, order_id=None, source_user_id=None, now=None):
+    if not delta:
+        return False
+    return conn.execute(
+        "INSERT OR IGNORE INTO bonus_ledger (user_id, delta, reason, order_id, source_user_id, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, delta, reason, order_id, source_user_id, int(now or time.time()))
+    ).rowcount == 1
+
+
+def balance(conn, user_id):
+    return conn.execute(
+        "SELECT COALESCE((SELECT bonuses FROM users WHERE user_id = :user), 0) + (" +
+        PENDING_SUM_SQL.format(user=':user') + ")",
+        {'user': user_id}
+    ).fetchone()[0]
+
+
+# Переносит пачку новых записей в снимок users.bonuses и сдвигает границу;
+# выполняется одной транзакцией, так что баланс при чтении не меняется
+def compact(conn, batch=COMPACT_BATCH):
+    through = conn.execute("SELECT through_entry_id FROM bonus_compaction").fetchone()[0]
+    count, upto = conn.execute(
+        "SELECT COUNT(*), MAX(entry_id) FROM "
+        "(SELECT entry_id FROM bonus_ledger WHERE entry_id > ? ORDER BY entry_id LIMIT ?)",
+        (through, batch)
+    ).fetchone()
+    if not count:
+        return 0
+    # Покупатель мог оформить заказ без /start, и строки users у него нет.
+    # Граница сдвигается за все записи пачки, поэтому строка создаётся здесь
+    # же (как при /start), иначе его бонусы выпали бы из снимка. Пригласившие
+    # проверяются при /start, так что чужих ID в журнале не бывает.
+    conn.execute(
+        "INSERT OR IGNORE INTO users (user_id, language, bonuses) "
+        "SELECT DISTINCT user_id, 'ru', 0 FROM bonus_ledger WHERE entry_id > ? AND entry_id <= ?",
+        (through, upto)
+    )
+    conn.execute(
+        "UPDATE users SET bonuses = bonuses + ("
+        "  SELECT SUM(l.delta) FROM bonus_ledger l WHERE l.user_id = users.user_id AND l.entry_id > ? AND l.entry_id <= ?"
+        ") WHERE user_id IN (SELECT user_id FROM bonus_ledger WHERE entry_id > ? AND entry_id <= ?)",
+        (through, upto, through, upto)
+    )
+    conn.execute("UPDATE bonus_compaction SET through_entry_id = ?", (upto,))
+    return count
+
+
+# Пользователи, у которых снимок расходится с суммой журнала до границы
+def audit(conn, limit=20):
+    return conn.execute(
+        "SELECT u.user_id, u.bonuses, COALESCE(l.total, 0) FROM users u "
+        "LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM bonus_ledger "
+        "           WHERE entry_id <= (SELECT through_entry_id FROM bonus_compaction) GROUP BY user_id) l "
+        "ON l.user_id = u.user_id "
+        "WHERE u.bonuses != COALESCE(l.total, 0) LIMIT ?",
+        (limit,)
+    ).fetchall()
+
+
+def recent_entries(conn, user_id, limit=10):
+    return conn.execute(
+        "SELECT entry_id, delta, reason, order_id, source_user_id, created_at FROM bonus_ledger "
+        "WHERE user_id = ? ORDER BY entry_id DESC LIMIT ?",
+        (user_id, limit)
+    ).fetchall()
+
+
+# Дерево приглашённых пользователя по индексу referred_by. Путь в строке
+# защищает от циклов (A пригласил B, B — A), глубина ограничена.
+def referral_tree(conn, user_id, max_depth=REFERRAL_DEPTH, limit=30):
+    tree = (
+        "WITH RECURSIVE tree (user_id, depth, path) AS ("
+        "  SELECT user_id, 1, ',' || :root || ',' || user_id || ',' FROM users WHERE referred_by = :root"
+        "  UNION ALL"
+        "  SELECT u.user_id, t.depth + 1, t.path || u.user_id || ',' FROM tree t"
+        "  JOIN users u ON u.referred_by = t.user_id"
+        "  WHERE t.depth < :depth AND instr(t.path, ',' || u.user_id || ',') = 0"
+        ") "
+    )
+    params = {'root': user_id, 'depth': max_depth, 'limit': limit}
+    levels = conn.execute(tree + "SELECT depth, COUNT(*) FROM tree GROUP BY depth ORDER BY depth", params).fetchall()
+    members = conn.execute(
+        tree + "SELECT t.user_id, t.depth, COALESCE(s.orders_count, 0), COALESCE(s.spent_kop, 0) FROM tree t "
+        "LEFT JOIN user_order_stats s ON s.user_id = t.user_id ORDER BY t.depth, t.user_id LIMIT :limit",
+        params
+    ).fetchall()
+    return levels, members
+
+
+# Лучшие пригласившие: прямые приглашения, размер сети до max_depth уровней
+# и заработанные реферальные бонусы
+def top_referrers(conn, limit=10, max_depth=REFERRAL_DEPTH):
+    return conn.execute(
+        "WITH RECURSIVE tree (root, user_id, depth) AS ("
+        "  SELECT referred_by, user_id, 1 FROM users WHERE referred_by IS NOT NULL"
+        "  UNION ALL"
+        "  SELECT t.root, u.user_id, t.depth + 1 FROM tree t JOIN users u ON u.referred_by = t.user_id"
+        "  WHERE t.depth < ? AND u.user_id != t.root"
+        ") "
+        "SELECT root, SUM(depth = 1) AS direct, COUNT(DISTINCT user_id) AS network, "
+        "       (SELECT COALESCE(SUM(l.delta), 0) FROM bonus_ledger l "
+        "        WHERE l.user_id = tree.root AND l.reason = 'referral') AS earned "
+        "FROM tree GROUP BY root ORDER BY network DESC, direct DESC LIMIT ?",
+        (max_depth, limit)
+    ).fetchall()
+
+
+# Периодическое сжатие журнала в снимок балансов
+class BonusCompactor:
+    def __init__(self, database, interval=COMPACT_INTERVAL, batch=COMPACT_BATCH):
+        self.db = database
+        self.interval = interval
+        self.batch = batch
+        self.compacted = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Bonus compactor started (every {self.interval}s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run_once(self):
+        total = 0
+        while True:
+            entries = await self.db.write(lambda conn: compact(conn, self.batch))
+            total += entries
+            if entries < self.batch:
+                break
+        self.compacted += total
+        return total
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                entries = await self.run_once()
+                if entries:
+                    logger.info(f"Compacted {entries} bonus ledger entries")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Bonus compaction failed: {e}")
@@ -0,0 +1,207 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Оценка квантиля линейной интерполяцией внутри корзины
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Значение gauge вычисляется в момент выгрузки
+    def gauge(self, name, fn, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            labels = dict(labels)
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{_labels(dict(labels))} {value}")
+        for (name, labels), fn in sorted(self.gauges.items(), key=lambda item: item[0]):
+            header(name, 'gauge')
+            try:
+                value = fn()
+            except Exception as e:
+                logger.error(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"{name}{_labels(dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        rows = []
+        for (metric, labels), histogram in sorted(self.histograms.items()):
+            if metric != name:
+                continue
+            rows.append((dict(labels), histogram))
+        return rows
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'Handler latency')
+metrics.describe('bot_handler_errors_total', 'Exceptions raised by handlers')
+metrics.describe('bot_db_seconds', 'Database call latency')
+metrics.describe('bot_log_errors_total', 'Error records logged by the bot')
+
+
+def instrument(callback, name):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+    return wrapper
+
+
+def instrument_application(application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            handler.callback = instrument(callback, getattr(callback, '__name__', type(callback).__name__))
+
+
+def observe_db(kind, seconds):
+    metrics.observe('bot_db_seconds', seconds, kind=kind)
+
+
+# Обработчики сами логируют исключения, поэтому ошибки считаются и по логам
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        metrics.inc('bot_log_errors_total', logger=record.name)
+
+
+# Минимальный HTTP-сервер для Prometheus: GET /metrics, а также GET /healthz,
+# который отвечает 200 только после того, как бот готов принимать обновления
+class MetricsServer:
+    def __init__(self, host='127.0.0.1', port=9090):
+        self.host = host
+        self.port = port
+        self.ready = False
+        self.routes = {
+            '/metrics': lambda: (200, 'text/plain; version=0.0.4', metrics.render()),
+            '/healthz': self._health,
+        }
+        self._server = None
+
+    def _health(self):
+        if self.ready:
+            return 200, 'text/plain', 'ok\n'
+        return 503, 'text/plain', 'starting\n'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Metrics server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+            route = self.routes.get(path)
+            if route is None:
+                status, content_type, body = 404, 'text/plain', 'not found\n'
+            else:
+                status, content_type, body = route()
+            payload = body.encode()
+            reason = {200: 'OK', 404: 'Not Found', 503: 'Service Unavailable'}.get(status, 'OK')
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
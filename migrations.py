@@ -0,0 +1,330 @@
+import logging
+from datetime import datetime
+
+from catalog import parse_price
+from stats import rebuild_aggregates
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 5000
+
+
+def create_base_schema(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS orders
+                 (user_id INTEGER, uc_amount TEXT, price TEXT, player_id TEXT, status TEXT, timestamp TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY, language TEXT, bonuses INTEGER, referral_code TEXT, referred_by TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS promos
+                 (code TEXT PRIMARY KEY, discount REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS banned_users
+                 (user_id INTEGER PRIMARY KEY)''')
+    c.execute("INSERT OR IGNORE INTO promos (code, discount) VALUES ('SUMMER10', 0.1)")
+    c.execute("INSERT OR IGNORE INTO promos (code, discount) VALUES ('WELCOME', 0.05)")
+
+
+def _legacy_amount(price):
+    try:
+        return parse_price(price)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _legacy_epoch(timestamp):
+    try:
+        return int(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _legacy_uc(uc_amount):
+    try:
+        return int(uc_amount)
+    except (TypeError, ValueError):
+        return 0
+
+
+# Заказы получают первичный ключ, числовые суммы (копейки) и время в epoch.
+# Старые строки переносятся пачками; при обрыве перенос продолжается
+# с последнего скопированного order_id.
+def orders_numeric_columns(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS orders_v2
+                 (order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  uc_amount INTEGER NOT NULL,
+                  price TEXT,
+                  amount_kop INTEGER NOT NULL DEFAULT 0,
+                  player_id TEXT,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  created_at INTEGER NOT NULL)''')
+    conn.commit()
+    last_id = c.execute("SELECT COALESCE(MAX(order_id), 0) FROM orders_v2").fetchone()[0]
+    copied = 0
+    while True:
+        rows = c.execute(
+            "SELECT rowid, user_id, uc_amount, price, player_id, status, timestamp FROM orders "
+            "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_id, BACKFILL_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        c.executemany(
+            "INSERT INTO orders_v2 (order_id, user_id, uc_amount, price, amount_kop, player_id, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(rowid, user_id, _legacy_uc(uc), price, _legacy_amount(price), player_id, status or 'pending',
+              _legacy_epoch(timestamp))
+             for rowid, user_id, uc, price, player_id, status, timestamp in rows]
+        )
+        conn.commit()
+        last_id = rows[-1][0]
+        copied += len(rows)
+        logger.info(f"Backfilled {copied} orders")
+    # Замена таблиц и индексы идут одной транзакцией вместе с user_version
+    c.execute("BEGIN")
+    c.execute("DROP TABLE orders")
+    c.execute("ALTER TABLE orders_v2 RENAME TO orders")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_status_created ON orders (user_id, status, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at, order_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, order_id)")
+
+
+# Материализованные агрегаты для статистики админа
+def sales_aggregates(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_totals
+                 (id INTEGER PRIMARY KEY CHECK (id = 1), orders_count INTEGER NOT NULL, revenue_kop INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_by_package
+                 (uc_amount INTEGER PRIMARY KEY, orders_count INTEGER NOT NULL, revenue_kop INTEGER NOT NULL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_by_day
+                 (day TEXT PRIMARY KEY, orders_count INTEGER NOT NULL, revenue_kop INTEGER NOT NULL)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_orders_sales AFTER INSERT ON orders
+                 BEGIN
+                     INSERT INTO sales_totals (id, orders_count, revenue_kop) VALUES (1, 1, NEW.amount_kop)
+                     ON CONFLICT (id) DO UPDATE SET orders_count = orders_count + 1,
+                                                    revenue_kop = revenue_kop + excluded.revenue_kop;
+                     INSERT INTO sales_by_package (uc_amount, orders_count, revenue_kop)
+                     VALUES (NEW.uc_amount, 1, NEW.amount_kop)
+                     ON CONFLICT (uc_amount) DO UPDATE SET orders_count = orders_count + 1,
+                                                           revenue_kop = revenue_kop + excluded.revenue_kop;
+                     INSERT INTO sales_by_day (day, orders_count, revenue_kop)
+                     VALUES (date(NEW.created_at, 'unixepoch', 'localtime'), 1, NEW.amount_kop)
+                     ON CONFLICT (day) DO UPDATE SET orders_count = orders_count + 1,
+                                                     revenue_kop = revenue_kop + excluded.revenue_kop;
+                 END''')
+    rebuild_aggregates(conn, ('sales_totals', 'sales_by_package', 'sales_by_day'))
+
+
+# Сводка по заказам пользователя для /history
+def user_order_stats(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS user_order_stats
+                 (user_id INTEGER PRIMARY KEY, orders_count INTEGER NOT NULL, spent_kop INTEGER NOT NULL)''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_orders_user_stats AFTER INSERT ON orders
+                 BEGIN
+                     INSERT INTO user_order_stats (user_id, orders_count, spent_kop) VALUES (NEW.user_id, 1, NEW.amount_kop)
+                     ON CONFLICT (user_id) DO UPDATE SET orders_count = orders_count + 1,
+                                                         spent_kop = spent_kop + excluded.spent_kop;
+                 END''')
+    rebuild_aggregates(conn, ('user_order_stats',))
+
+
+# Отложенные напоминания (не больше одного на пользователя)
+def reminders_table(conn):
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS reminders (user_id INTEGER PRIMARY KEY, due_at INTEGER NOT NULL)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (due_at)")
+
+
+# Сохранённые context.user_data
+def user_data_table(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_data
+                    (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at INTEGER NOT NULL)''')
+
+
+# Обработанные update_id для идемпотентной повторной доставки
+def processed_updates_table(conn):
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY, received_at INTEGER NOT NULL)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_received ON processed_updates (received_at)")
+
+
+# Срок действия и лимиты промокодов; NULL означает «без ограничения»
+def promo_limits(conn):
+    c = conn.cursor()
+    c.execute("ALTER TABLE promos ADD COLUMN expires_at INTEGER")
+    c.execute("ALTER TABLE promos ADD COLUMN max_uses INTEGER")
+    c.execute("ALTER TABLE promos ADD COLUMN per_user_limit INTEGER")
+    c.execute("ALTER TABLE promos ADD COLUMN used INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE promos ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    c.execute('''CREATE TABLE IF NOT EXISTS promo_redemptions
+                 (redemption_id INTEGER PRIMARY KEY, code TEXT NOT NULL, user_id INTEGER NOT NULL,
+                  order_id INTEGER, redeemed_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_promo_redemptions_code_user ON promo_redemptions (code, user_id)")
+
+
+# Журнал бонусов вместо UPDATE users.bonuses на месте: users.bonuses становится
+# снимком журнала до bonus_compaction.through_entry_id. Таблица users
+# пересоздаётся, чтобы referred_by стал INTEGER с индексом.
+def bonus_ledger(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE users_v2
+                 (user_id INTEGER PRIMARY KEY, language TEXT, bonuses INTEGER NOT NULL DEFAULT 0,
+                  referral_code TEXT, referred_by INTEGER)''')
+    c.execute(
+        "INSERT INTO users_v2 (user_id, language, bonuses, referral_code, referred_by) "
+        "SELECT user_id, language, COALESCE(bonuses, 0), referral_code, "
+        "       CASE WHEN referred_by GLOB '[0-9]*' AND referred_by NOT GLOB '*[^0-9]*' "
+        "                 AND CAST(referred_by AS INTEGER) != user_id "
+        "            THEN CAST(referred_by AS INTEGER) END "
+        "FROM users"
+    )
+    c.execute("DROP TABLE users")
+    c.execute("ALTER TABLE users_v2 RENAME TO users")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)")
+    c.execute('''CREATE TABLE IF NOT EXISTS bonus_ledger
+                 (entry_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, delta INTEGER NOT NULL,
+                  reason TEXT NOT NULL, order_id INTEGER, source_user_id INTEGER, created_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bonus_ledger_user ON bonus_ledger (user_id, entry_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bonus_ledger_order ON bonus_ledger (order_id, reason, user_id) "
+              "WHERE order_id IS NOT NULL")
+    c.execute('''CREATE TABLE IF NOT EXISTS bonus_compaction
+                 (id INTEGER PRIMARY KEY CHECK (id = 1), through_entry_id INTEGER NOT NULL)''')
+    # Текущие балансы становятся начальными записями журнала, уже учтёнными в снимке
+    c.execute("INSERT INTO bonus_ledger (user_id, delta, reason, created_at) "
+              "SELECT user_id, bonuses, 'opening', CAST(strftime('%s', 'now') AS INTEGER) FROM users WHERE bonuses != 0")
+    c.execute("INSERT INTO bonus_compaction (id, through_entry_id) SELECT 1, COALESCE(MAX(entry_id), 0) FROM bonus_ledger")
+
+
+# Рассылки с контрольной точкой и пользователи, заблокировавшие бота
+def broadcasts_table(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts
+                 (broadcast_id INTEGER PRIMARY KEY, text TEXT NOT NULL, status TEXT NOT NULL,
+                  cursor_user_id INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0,
+                  sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+                  blocked INTEGER NOT NULL DEFAULT 0, progress_chat_id INTEGER, progress_message_id INTEGER,
+                  created_at INTEGER NOT NULL, updated_at INTEGER NOT NULL)''')
+    c.execute("CREATE TABLE IF NOT EXISTS unreachable_users (user_id INTEGER PRIMARY KEY, since INTEGER NOT NULL)")
+
+
+
+# Перцептивные хеши скриншотов оплаты. 64-битный хеш разбит на 8 полос по
+# байту: у хешей на расстоянии Хэмминга до 7 хотя бы одна полоса совпадает,
+# поэтому кандидаты в дубликаты ищутся по индексу (band, value).
+def screenshots_table(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS screenshots
+                 (screenshot_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, order_id INTEGER,
+                  file_unique_id TEXT NOT NULL, phash INTEGER, duplicate_of INTEGER, distance INTEGER,
+                  created_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_file ON screenshots (file_unique_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_order ON screenshots (order_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS screenshot_bands
+                 (band INTEGER NOT NULL, value INTEGER NOT NULL, screenshot_id INTEGER NOT NULL,
+                  PRIMARY KEY (band, value, screenshot_id)) WITHOUT ROWID''')
+
+
+
+# Хеши скриншотов становятся 256-битными (BLOB) с детальным эскизом для
+# подтверждения совпадения; старые 64-битные хеши несравнимы и удаляются
+def screenshot_detail(conn):
+    c = conn.cursor()
+    c.execute("ALTER TABLE screenshots ADD COLUMN detail BLOB")
+    c.execute("UPDATE screenshots SET phash = NULL")
+    c.execute("DELETE FROM screenshot_bands")
+
+
+# В сумму «потрачено» входят только выполненные заказы: при вставке
+# учитывается статус, а подтверждение оплаты добавляет сумму позже
+def user_spent_completed(conn):
+    c = conn.cursor()
+    c.execute("DROP TRIGGER IF EXISTS trg_orders_user_stats")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_orders_user_stats AFTER INSERT ON orders
+                 BEGIN
+                     INSERT INTO user_order_stats (user_id, orders_count, spent_kop)
+                     VALUES (NEW.user_id, 1, CASE WHEN NEW.status = 'completed' THEN NEW.amount_kop ELSE 0 END)
+                     ON CONFLICT (user_id) DO UPDATE SET orders_count = orders_count + 1,
+                                                         spent_kop = spent_kop + excluded.spent_kop;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_orders_user_spent AFTER UPDATE OF status ON orders
+                 WHEN (OLD.status = 'completed') != (NEW.status = 'completed')
+                 BEGIN
+                     UPDATE user_order_stats
+                     SET spent_kop = spent_kop + CASE WHEN NEW.status = 'completed'
+                                                      THEN NEW.amount_kop ELSE -OLD.amount_kop END
+                     WHERE user_id = NEW.user_id;
+                 END''')
+    rebuild_aggregates(conn, ('user_order_stats',))
+
+
+# Архив старых заказов — отдельный файл archive.db, подключённый к каждому
+# соединению как схема archive. Таблица повторяет orders, индексы те же, что
+# нужны истории и выгрузке. Режим журнала нельзя сменить внутри транзакции,
+# поэтому миграция сама открывает её после PRAGMA.
+def archive_orders(conn):
+    c = conn.cursor()
+    c.execute("PRAGMA archive.journal_mode = WAL")
+    c.execute("BEGIN")
+    c.execute('''CREATE TABLE IF NOT EXISTS archive.orders
+                 (order_id INTEGER PRIMARY KEY,
+                  user_id INTEGER NOT NULL,
+                  uc_amount INTEGER NOT NULL,
+                  price TEXT,
+                  amount_kop INTEGER NOT NULL DEFAULT 0,
+                  player_id TEXT,
+                  status TEXT NOT NULL,
+                  created_at INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_user_created ON orders (user_id, created_at, order_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_status_created ON orders (status, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_created ON orders (created_at, order_id)")
+
+
+MIGRATIONS = [
+    (1, create_base_schema),
+    (2, orders_numeric_columns),
+    (3, sales_aggregates),
+    (4, user_order_stats),
+    (5, reminders_table),
+    (6, user_data_table),
+    (7, processed_updates_table),
+    (8, promo_limits),
+    (9, bonus_ledger),
+    (10, broadcasts_table),
+    (11, screenshots_table),
+    (12, screenshot_detail),
+    (13, user_spent_completed),
+    (14, archive_orders),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# Миграции, которые сами управляют транзакцией: фиксируют промежуточные
+# пачки и продолжаются после обрыва или меняют режим журнала перед BEGIN;
+# остальные выполняются целиком в одной транзакции
+RESUMABLE_MIGRATIONS = (orders_numeric_columns, archive_orders)
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    version = current_version(conn)
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f"Applying migration {target}: {migration.__name__}")
+        try:
+            # sqlite3 не открывает транзакцию перед DDL сам: без явного BEGIN
+            # каждый ALTER/CREATE фиксировался бы отдельно и откат не работал
+            if migration not in RESUMABLE_MIGRATIONS and not conn.in_transaction:
+                conn.execute("BEGIN")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+    return version
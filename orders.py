@@ -0,0 +1,113 @@
+import time
+
+import archive
+
+
+# Операции с заказами; выполняются на соединении-писателе внутри транзакции
+def insert_order(conn, user_id, uc_amount, price, amount_kop, status='pending', created_at=None):
+    cur = conn.execute(
+        "INSERT INTO orders (user_id, uc_amount, price, amount_kop, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, int(uc_amount), price, amount_kop, status, int(created_at or time.time()))
+    )
+    return cur.lastrowid
+
+
+def set_pending_player_id(conn, user_id, player_id):
+    return conn.execute(
+        "UPDATE orders SET player_id = ? WHERE user_id = ? AND status = 'pending'",
+        (player_id, user_id)
+    ).rowcount
+
+
+# Ожидающие оплаты заказы старше cutoff становятся просроченными; пачка
+# выбирается по индексу (status, created_at)
+def expire_pending(conn, cutoff, limit=5000):
+    return conn.execute(
+        "UPDATE orders SET status = 'expired' WHERE order_id IN "
+        "(SELECT order_id FROM orders WHERE status = 'pending' AND created_at < ? LIMIT ?)",
+        (cutoff, limit)
+    ).rowcount
+
+
+# Подтверждение оплаты админом. Просроченный заказ тоже можно завершить:
+# оплата могла прийти позже срока, а сам заказ уже уйти в архив. Пока
+# заказ есть в живой таблице, она главнее архивной копии. Возвращает
+# (user_id, uc_amount) или None.
+def complete_order(conn, order_id):
+    for schema in ('main', 'archive'):
+        row = conn.execute(
+            f"SELECT user_id, uc_amount, amount_kop, status FROM {schema}.orders WHERE order_id = ?",
+            (order_id,)
+        ).fetchone()
+        if row is not None:
+            break
+    if row is None or row[3] not in ('pending', 'expired'):
+        return None
+    user_id, uc_amount, amount_kop, _ = row
+    conn.execute(f"UPDATE {schema}.orders SET status = 'completed' WHERE order_id = ?", (order_id,))
+    # Триггеры сводки висят только на живой таблице
+    if schema == 'archive':
+        conn.execute(
+            "UPDATE user_order_stats SET spent_kop = spent_kop + ? WHERE user_id = ?", (amount_kop, user_id)
+        )
+    return user_id, uc_amount
+
+
+def latest_pending_order_id(conn, user_id):
+    row = conn.execute(
+        "SELECT order_id FROM orders WHERE user_id = ? AND status = 'pending' "
+        "ORDER BY created_at DESC, order_id DESC LIMIT 1",
+        (user_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+ORDER_STATUSES = ('pending', 'completed', 'expired')
+PAGE_SIZE = 10
+PAGE_CALLBACK = 'admin_orders'
+
+
+# Постраничный просмотр по ключу (created_at, order_id), от новых к старым.
+# direction: 'first' — первая страница, 'older'/'newer' — от курсора.
+# include_archive добавляет заказы, перенесённые в архив.
+def fetch_orders_page(conn, direction='first', cursor=None, status=None, user_id=None, limit=PAGE_SIZE,
+                      include_archive=False):
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if user_id:
+        where.append("user_id = ?")
+        params.append(user_id)
+    order = "DESC"
+    if direction == 'older' and cursor:
+        where.append("(created_at, order_id) < (?, ?)")
+        params.extend(cursor)
+    elif direction == 'newer' and cursor:
+        where.append("(created_at, order_id) > (?, ?)")
+        params.extend(cursor)
+        order = "ASC"
+    sql = archive.union_sql("order_id, user_id, uc_amount, price, status, created_at", " AND ".join(where),
+                            f"ORDER BY created_at {order}, order_id {order} LIMIT ?", include_archive)
+    rows = conn.execute(sql, params * (2 if include_archive else 1) + [limit + 1]).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, direction == 'older' and bool(cursor)
+
+
+def page_callback(direction, row=None, status=None, user_id=None, include_archive=False):
+    created_at, order_id = (row[5], row[0]) if row else ('', '')
+    return (f"{PAGE_CALLBACK}:{direction}:{created_at}:{order_id}:{status or ''}:{user_id or ''}"
+            f"{':a' if include_archive else ''}")
+
+
+def parse_page_callback(data):
+    parts = data.split(':')
+    if len(parts) not in (6, 7):
+        return 'first', None, None, None, False
+    _, direction, created_at, order_id, status, user_id = parts[:6]
+    cursor = (int(created_at), int(order_id)) if created_at and order_id else None
+    return direction, cursor, status or None, int(user_id) if user_id else None, parts[6:] == ['a']
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+# Сколько уведомлений может ждать в очереди админа, прежде чем новые
+# уйдут в дайджест
+ADMIN_BACKLOG = 20
+# Сколько сообщений занимает один дайджест; остальное сводится к счётчику
+DIGEST_MESSAGES = 5
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Резервирует токен и возвращает, сколько секунд нужно подождать
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# Фоновая очередь исходящих сообщений. Обработчики только ставят сообщения
+# в очередь; отправка идёт с лимитами на чат и на бота в целом, с учётом
+# RetryAfter. Уведомления админу о заказах собираются в дайджест по
+# интервалу, а без интервала — когда очередь админа переполнена.
+class Outbox:
+    def __init__(self, global_rate=25, chat_rate=1, chat_burst=3, workers=8, max_attempts=5,
+                 admin_backlog=ADMIN_BACKLOG, digest_messages=DIGEST_MESSAGES):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.admin_backlog = admin_backlog
+        self.digest_messages = digest_messages
+        self.bot = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._chats = {}
+        self._buckets = {}
+        self._ready = asyncio.Queue()
+        self._tasks = []
+        self._paused_until = 0.0
+        self._digest = []
+        self._digest_chat = None
+        self._digest_interval = 0
+
+    @property
+    def depth(self):
+        return sum(len(items) for items in self._chats.values())
+
+    def start(self, bot, digest_chat=None, digest_interval=0):
+        self.bot = bot
+        self._digest_chat = digest_chat
+        self._digest_interval = digest_interval
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintenance()))
+        logger.info(f"Outbox started with {self.workers} workers"
+                    + (f", admin digest every {digest_interval}s" if digest_interval else ""))
+
+    async def stop(self, timeout=10):
+        self._flush_digest()
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _enqueue(self, chat_id, method, kwargs):
+        items = self._chats.get(chat_id)
+        if items is None:
+            items = self._chats[chat_id] = deque()
+        items.append([method, kwargs, 0])
+        # Чат попадает в очередь готовых только один раз: так сохраняется порядок
+        if len(items) == 1:
+            self._ready.put_nowait(chat_id)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._enqueue(chat_id, 'send_message', dict(chat_id=chat_id, text=text, **kwargs))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self._enqueue(chat_id, 'send_photo', dict(chat_id=chat_id, photo=photo, **kwargs))
+
+    def notify_admin(self, chat_id, text):
+        if self._digest_interval or len(self._chats.get(chat_id, ())) >= self.admin_backlog:
+            self._digest.append(text)
+        else:
+            self.send_message(chat_id, text)
+
+    def _flush_digest(self):
+        if not self._digest:
+            return
+        entries, self._digest = self._digest, []
+        header = f"Заказы за период ({len(entries)}):\n\n"
+        chunk = header
+        messages = 0
+        for index, entry in enumerate(entries):
+            # Запас под строку с числом оставшихся уведомлений
+            if len(chunk) + len(entry) + 2 > MESSAGE_LIMIT - 64:
+                messages += 1
+                if messages == self.digest_messages:
+                    chunk += f"…и ещё {len(entries) - index}, полный список в /orders"
+                    break
+                self.send_message(self._digest_chat, chunk)
+                chunk = ""
+            chunk += entry + "\n\n"
+        if chunk.strip():
+            self.send_message(self._digest_chat, chunk)
+
+    async def _maintenance(self):
+        last_digest = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            if self._digest_interval:
+                if now - last_digest >= self._digest_interval:
+                    last_digest = now
+                    self._flush_digest()
+            # Без интервала дайджест накопленного уходит, когда очередь админа разобрана
+            elif self._digest and self._digest_chat not in self._chats:
+                self._flush_digest()
+            for chat_id in [c for c, b in self._buckets.items() if c not in self._chats and b.idle]:
+                del self._buckets[chat_id]
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            items = self._chats[chat_id]
+            try:
+                await self._deliver(chat_id, items[0])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox worker failed for chat {chat_id}: {e}")
+                items.popleft()
+            if items:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def _deliver(self, chat_id, item):
+        method, kwargs, attempts = item
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        try:
+            await getattr(self.bot, method)(**kwargs)
+            self.sent += 1
+        except RetryAfter as e:
+            # Флуд-лимит: останавливаем все отправки на указанное время
+            self.retried += 1
+            self._paused_until = time.monotonic() + e.retry_after
+            logger.warning(f"Flood limit hit for chat {chat_id}, retrying in {e.retry_after}s")
+            return
+        except (Forbidden, BadRequest) as e:
+            self.failed += 1
+            logger.error(f"Outbox dropped {method} to {chat_id}: {e}")
+        except NetworkError as e:
+            item[2] = attempts + 1
+            if item[2] < self.max_attempts:
+                self.retried += 1
+                logger.warning(f"Outbox {method} to {chat_id} failed ({e}), attempt {item[2]}")
+                await asyncio.sleep(min(2 ** attempts, 30))
+                return
+            self.failed += 1
+            logger.error(f"Outbox gave up on {method} to {chat_id}: {e}")
+        self._chats[chat_id].popleft()
+
+
+outbox = Outbox()
@@ -0,0 +1,105 @@
+import json
+import logging
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+def _dump(data):
+    return json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+# Хранение context.user_data в bot.db. Данные пользователя загружаются
+# при первом обращении (refresh_user_data), а записываются только те
+# записи, которые действительно изменились, через общую очередь записи,
+# так что все изменения одного цикла уходят одной транзакцией.
+class SqlitePersistence(BasePersistence):
+    def __init__(self, database, write_queue, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = database
+        self.writes = write_queue
+        self.loaded = 0
+        self.written = 0
+        self.skipped = 0
+        self._stored = {}
+
+    async def get_user_data(self):
+        # Ничего не загружаем заранее: данные подтягиваются по пользователю
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._stored:
+            return
+        row = await self.db.fetchone("SELECT data FROM user_data WHERE user_id = ?", (user_id,))
+        if user_id in self._stored:
+            return
+        stored = row[0] if row else _dump({})
+        self._stored[user_id] = stored
+        if row:
+            # Уже изменённые в памяти значения важнее сохранённых
+            for key, value in json.loads(stored).items():
+                user_data.setdefault(key, value)
+            self.loaded += 1
+
+    async def update_user_data(self, user_id, data):
+        serialized = _dump(data)
+        if self._stored.get(user_id) == serialized:
+            self.skipped += 1
+            return
+        if data:
+            await self.writes.submit(lambda conn: conn.execute(
+                "INSERT INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (user_id, serialized, int(time.time()))
+            ))
+        else:
+            await self.writes.submit(lambda conn: conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,)))
+        self._stored[user_id] = serialized
+        self.written += 1
+
+    async def drop_user_data(self, user_id):
+        await self.writes.submit(lambda conn: conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,)))
+        self._stored[user_id] = _dump({})
+
+    async def flush(self):
+        await self.writes.flush()
+        logger.info(f"Persistence flushed: {self.written} writes, {self.skipped} unchanged, {self.loaded} loaded")
+
+    # Остальные виды данных не хранятся
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
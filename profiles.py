@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from db import db
+from ledger import PENDING_SUM_SQL
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Profile:
+    user_id: int
+    language: str
+    bonuses: int
+    referred_by: Optional[int]
+    banned: bool
+    registered: bool
+
+
+# Кэш профилей пользователей (LRU с ограничением по времени жизни).
+# Запись сквозная: код, меняющий users/banned_users, обновляет кэш сам.
+class ProfileCache:
+    def __init__(self, database, maxsize=10000, ttl=600):
+        self.db = database
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+
+    def _load(self, conn, user_id):
+        row = conn.execute(
+            "SELECT u.user_id IS NOT NULL, u.language, COALESCE(u.bonuses, 0) + (" +
+            PENDING_SUM_SQL.format(user='k.user_id') + "), u.referred_by, "
+            "EXISTS(SELECT 1 FROM banned_users b WHERE b.user_id = k.user_id) "
+            "FROM (SELECT ? AS user_id) k LEFT JOIN users u ON u.user_id = k.user_id",
+            (user_id,)
+        ).fetchone()
+        registered, lang, bonuses, referred_by, banned = row
+        return Profile(user_id, lang or 'ru', bonuses or 0, referred_by, bool(banned), bool(registered))
+
+    def _put(self, profile):
+        self._entries[profile.user_id] = (profile, time.monotonic() + self.ttl)
+        self._entries.move_to_end(profile.user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def peek(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        profile, expires = entry
+        if expires < time.monotonic():
+            del self._entries[user_id]
+            return None
+        return profile
+
+    async def get(self, user_id):
+        profile = self.peek(user_id)
+        if profile is not None:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return profile
+        self.misses += 1
+        # Параллельные промахи по одному пользователю ждут одну загрузку
+        pending = self._loading.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self.db.read(lambda conn: self._load(conn, user_id)))
+            self._loading[user_id] = pending
+            try:
+                profile = await pending
+                self._put(profile)
+            finally:
+                self._loading.pop(user_id, None)
+            return profile
+        return await asyncio.shield(pending)
+
+    def update(self, user_id, **fields):
+        profile = self.peek(user_id)
+        if profile is None:
+            return
+        for name, value in fields.items():
+            setattr(profile, name, value)
+
+    def add_bonuses(self, user_id, delta):
+        profile = self.peek(user_id)
+        if profile is not None:
+            profile.bonuses += delta
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+profiles = ProfileCache(db)
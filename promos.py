@@ -0,0 +1,150 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from catalog import to_basis_points
+from db import db
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 60
+
+
+@dataclass
+class Promo:
+    code: str
+    discount: int  # базисные пункты
+    expires_at: Optional[int]  # None — бессрочный
+    max_uses: Optional[int]  # None — без общего лимита
+    per_user_limit: Optional[int]  # None — без лимита на пользователя
+    used: int
+
+
+def normalize_code(code):
+    return code.strip().upper()
+
+
+# Списание промокода внутри транзакции заказа. Условный UPDATE выполняется
+# единственным писателем, поэтому лимиты нельзя превысить даже при
+# одновременных заказах; возвращает скидку в базисных пунктах или 0.
+def claim(conn, code, user_id, now=None):
+    now = int(now or time.time())
+    claimed = conn.execute(
+        "UPDATE promos SET used = used + 1 "
+        "WHERE code = ? AND active = 1 "
+        "  AND (expires_at IS NULL OR expires_at > ?) "
+        "  AND (max_uses IS NULL OR used < max_uses) "
+        "  AND (per_user_limit IS NULL OR per_user_limit > "
+        "       (SELECT COUNT(*) FROM promo_redemptions r WHERE r.code = promos.code AND r.user_id = ?))",
+        (code, now, user_id)
+    ).rowcount
+    if not claimed:
+        return 0
+    discount = conn.execute("SELECT discount FROM promos WHERE code = ?", (code,)).fetchone()[0]
+    return to_basis_points(discount)
+
+
+def record(conn, code, user_id, order_id, now=None):
+    conn.execute(
+        "INSERT INTO promo_redemptions (code, user_id, order_id, redeemed_at) VALUES (?, ?, ?, ?)",
+        (code, user_id, order_id, int(now or time.time()))
+    )
+
+
+def upsert(conn, code, discount, expires_at=None, max_uses=None, per_user_limit=None):
+    conn.execute(
+        "INSERT INTO promos (code, discount, expires_at, max_uses, per_user_limit, active) "
+        "VALUES (?, ?, ?, ?, ?, 1) "
+        "ON CONFLICT (code) DO UPDATE SET discount = excluded.discount, expires_at = excluded.expires_at, "
+        "max_uses = excluded.max_uses, per_user_limit = excluded.per_user_limit, active = 1",
+        (code, discount, expires_at, max_uses, per_user_limit)
+    )
+
+
+def deactivate(conn, code):
+    return conn.execute("UPDATE promos SET active = 0 WHERE code = ?", (code,)).rowcount
+
+
+def list_promos(conn):
+    return conn.execute(
+        "SELECT code, discount, expires_at, max_uses, per_user_limit, used, active "
+        "FROM promos ORDER BY active DESC, code"
+    ).fetchall()
+
+
+# Индекс действующих промокодов в памяти: проверка кода при вводе не читает
+# БД, кроме разового подсчёта использований для кодов с личным лимитом.
+# Индекс перезагружается после правок админа и раз в REFRESH_INTERVAL
+# (правки из других процессов). Окончательное решение принимает claim().
+class PromoEngine:
+    def __init__(self, database, refresh_interval=REFRESH_INTERVAL):
+        self.db = database
+        self.refresh_interval = refresh_interval
+        self.version = 0
+        self._promos = {}
+        self._user_uses = {}
+        self._loaded_at = None
+
+    def _load(self, conn):
+        now = int(time.time())
+        return {
+            row[0]: Promo(row[0], to_basis_points(row[1]), row[2], row[3], row[4], row[5])
+            for row in conn.execute(
+                "SELECT code, discount, expires_at, max_uses, per_user_limit, used FROM promos "
+                "WHERE active = 1 AND (expires_at IS NULL OR expires_at > ?)",
+                (now,)
+            )
+        }
+
+    async def refresh(self):
+        self._promos = await self.db.read(self._load)
+        # Счётчики пользователей перечитываются лениво, по мере проверок
+        self._user_uses = {}
+        self._loaded_at = time.monotonic()
+        self.version += 1
+        logger.info(f"Promo index loaded: {len(self._promos)} active codes (version {self.version})")
+
+    async def _ensure_fresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            await self.refresh()
+
+    # Использования кода пользователем читаются по индексу (code, user_id)
+    # при первой проверке и кэшируются до следующей перезагрузки индекса
+    async def _user_uses_of(self, code, user_id):
+        key = (code, user_id)
+        if key not in self._user_uses:
+            self._user_uses[key] = await self.db.read(lambda conn: conn.execute(
+                "SELECT COUNT(*) FROM promo_redemptions WHERE code = ? AND user_id = ?", key
+            ).fetchone()[0])
+        return self._user_uses[key]
+
+    # Возвращает (Promo, None) или (None, ключ сообщения об ошибке)
+    async def check(self, code, user_id, now=None):
+        await self._ensure_fresh()
+        promo = self._promos.get(normalize_code(code))
+        if promo is None:
+            return None, 'promo_invalid'
+        if promo.expires_at is not None and promo.expires_at <= (now or time.time()):
+            return None, 'promo_expired'
+        if promo.max_uses is not None and promo.used >= promo.max_uses:
+            return None, 'promo_exhausted'
+        if promo.per_user_limit is not None and \
+                await self._user_uses_of(promo.code, user_id) >= promo.per_user_limit:
+            return None, 'promo_used'
+        return promo, None
+
+    # Вызывается после фиксации заказа, чтобы индекс не ждал перезагрузки
+    def note_redeemed(self, code, user_id):
+        promo = self._promos.get(code)
+        if promo is None:
+            return
+        promo.used += 1
+        if (code, user_id) in self._user_uses:
+            self._user_uses[(code, user_id)] += 1
+
+    def stats(self):
+        return {'active': len(self._promos), 'version': self.version}
+
+
+promos = PromoEngine(db)
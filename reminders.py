@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+REMINDER_DELAY = 600
+SWEEP_INTERVAL = 30
+SWEEP_BATCH = 500
+
+
+# Не больше одного напоминания на пользователя: повторный /start
+# или новый заказ только сдвигают срок
+def schedule_reminder(conn, user_id, delay=REMINDER_DELAY, now=None):
+    due_at = int((now or time.time()) + delay)
+    conn.execute(
+        "INSERT INTO reminders (user_id, due_at) VALUES (?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET due_at = excluded.due_at",
+        (user_id, due_at)
+    )
+
+
+# Забирает пачку наступивших напоминаний одним запросом по индексу due_at;
+# последний незавершённый заказ ищется по индексу (user_id, status, created_at)
+def claim_due(conn, now, limit=SWEEP_BATCH):
+    rows = conn.execute(
+        "SELECT r.user_id, COALESCE(u.language, 'ru'), "
+        "       (SELECT o.uc_amount FROM orders o "
+        "        WHERE o.user_id = r.user_id AND o.status = 'pending' "
+        "        ORDER BY o.created_at DESC LIMIT 1), "
+        "       EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = r.user_id) "
+        "FROM reminders r LEFT JOIN users u ON u.user_id = r.user_id "
+        "WHERE r.due_at <= ? ORDER BY r.due_at LIMIT ?",
+        (now, limit)
+    ).fetchall()
+    conn.executemany("DELETE FROM reminders WHERE user_id = ?", [(row[0],) for row in rows])
+    return rows
+
+
+# Периодический обход напоминаний; состояние хранится в БД,
+# поэтому напоминания переживают перезапуск
+class ReminderScheduler:
+    def __init__(self, database, send, interval=SWEEP_INTERVAL, batch=SWEEP_BATCH):
+        self.db = database
+        self.send = send
+        self.interval = interval
+        self.batch = batch
+        self.sent = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Reminder scheduler started (every {self.interval}s)")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def sweep(self, now=None):
+        now = int(now or time.time())
+        total = 0
+        while True:
+            rows = await self.db.write(lambda conn: claim_due(conn, now, self.batch))
+            for user_id, lang, uc_amount, banned in rows:
+                if uc_amount is not None and not banned:
+                    self.send(user_id, lang, uc_amount)
+                    total += 1
+            if len(rows) < self.batch:
+                break
+        self.sent += total
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                sent = await self.sweep()
+                if sent:
+                    logger.info(f"Sent {sent} reminders")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Reminder sweep failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Optional
+
+from PIL import Image, ImageChops
+
+import orders
+
+logger = logging.getLogger(__name__)
+
+# dHash 16x16 (256 бит) находит снимки с той же картинкой: пересжатие,
+# смена размера, обрезка полей дают расстояние Хэмминга до MAX_DISTANCE.
+# Но чеки одного банка с разными суммами и датами тоже близки, поэтому
+# хеш только отбирает кандидатов; для чужих снимков совпадение
+# подтверждается сравнением детального эскиза DETAIL_SIZE.
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+MAX_DISTANCE = 12
+# 16 полос по 16 бит: при расстоянии до 15 хотя бы одна полоса совпадает
+BANDS = 16
+BAND_BITS = HASH_BITS // BANDS
+DETAIL_SIZE = (128, 256)
+# Пиксели эскиза, отличающиеся сильнее, считаются разным содержимым
+# (другая цифра суммы, другое время); пересжатие даёт отличия меньше
+DETAIL_TOLERANCE = 32
+DETAIL_CANDIDATES = 50
+HASH_WORKERS = 2
+
+
+# Хеш и сжатый детальный эскиз одного снимка. Выполняется в отдельном
+# процессе, поэтому функция верхнего уровня.
+def fingerprint(data):
+    with Image.open(BytesIO(data)) as image:
+        # Для JPEG декодирование сразу в уменьшенном масштабе в разы быстрее
+        image.draft('L', (DETAIL_SIZE[0] * 2, DETAIL_SIZE[1] * 2))
+        gray = image.convert('L')
+        pixels = gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).tobytes()
+        detail = gray.resize(DETAIL_SIZE, Image.BILINEAR).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value, zlib.compress(detail, 6)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# 256-битный хеш хранится в BLOB
+def _to_blob(value):
+    return value.to_bytes(HASH_BITS // 8, 'big')
+
+
+def _from_blob(blob):
+    return int.from_bytes(blob, 'big')
+
+
+def _bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (value >> (band * BAND_BITS)) & mask) for band in range(BANDS)]
+
+
+# Содержимое совпадает, если ни один пиксель эскизов не отличается
+# сильнее DETAIL_TOLERANCE; сравнение идёт в C-коде Pillow
+def same_detail(detail, other):
+    if detail is None or other is None:
+        return False
+    a = Image.frombytes('L', DETAIL_SIZE, zlib.decompress(detail))
+    b = Image.frombytes('L', DETAIL_SIZE, zlib.decompress(other))
+    return ImageChops.difference(a, b).point(lambda v: 255 if v > DETAIL_TOLERANCE else 0).getbbox() is None
+
+
+@dataclass
+class ScreenshotCheck:
+    screenshot_id: int
+    order_id: Optional[int]
+    duplicate_of: Optional[int] = None
+    duplicate_user_id: Optional[int] = None
+    duplicate_order_id: Optional[int] = None
+    distance: Optional[int] = None
+
+
+# Ближайший похожий снимок. Свои снимки пользователя достаточно близости
+# хеша (повторная отправка), чужие — только с подтверждённым эскизом;
+# подтверждённый чужой снимок важнее своего.
+def _nearest(conn, phash, detail, user_id, max_distance):
+    where = " OR ".join(["(b.band = ? AND b.value = ?)"] * BANDS)
+    params = [item for pair in _bands(phash) for item in pair]
+    candidates = []
+    for screenshot_id, other_user, order_id, other in conn.execute(
+        "SELECT DISTINCT s.screenshot_id, s.user_id, s.order_id, s.phash FROM screenshot_bands b "
+        f"JOIN screenshots s ON s.screenshot_id = b.screenshot_id WHERE {where}",
+        params
+    ):
+        distance = hamming(phash, _from_blob(other))
+        if distance <= max_distance:
+            candidates.append((distance, screenshot_id, other_user, order_id))
+    candidates.sort()
+    own = next((c for c in candidates if c[2] == user_id), None)
+    for distance, screenshot_id, other_user, order_id in [c for c in candidates if c[2] != user_id][:DETAIL_CANDIDATES]:
+        other_detail = conn.execute(
+            "SELECT detail FROM screenshots WHERE screenshot_id = ?", (screenshot_id,)
+        ).fetchone()[0]
+        if same_detail(detail, other_detail):
+            return screenshot_id, other_user, order_id, distance
+    return (own[1], own[2], own[3], own[0]) if own else None
+
+
+# Поиск похожего снимка и запись нового выполняются одной транзакцией
+# писателя, так что два одновременных дубликата не пропустят друг друга.
+# Без хеша (тот же файл Telegram) дубликат ищется по file_unique_id.
+def register(conn, user_id, file_unique_id, phash, detail=None, max_distance=MAX_DISTANCE, now=None):
+    order_id = orders.latest_pending_order_id(conn, user_id)
+    if phash is None:
+        row = conn.execute(
+            "SELECT screenshot_id, user_id, order_id, phash, detail FROM screenshots WHERE file_unique_id = ? "
+            "ORDER BY screenshot_id LIMIT 1",
+            (file_unique_id,)
+        ).fetchone()
+        match = (row[0], row[1], row[2], 0) if row else None
+        phash = _from_blob(row[3]) if row and row[3] is not None else None
+        detail = row[4] if row else None
+    else:
+        match = _nearest(conn, phash, detail, user_id, max_distance)
+    screenshot_id = conn.execute(
+        "INSERT INTO screenshots (user_id, order_id, file_unique_id, phash, detail, duplicate_of, distance, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (user_id, order_id, file_unique_id, _to_blob(phash) if phash is not None else None, detail,
+         match[0] if match else None, match[3] if match else None, int(now or time.time()))
+    ).lastrowid
+    if phash is not None:
+        conn.executemany(
+            "INSERT INTO screenshot_bands (band, value, screenshot_id) VALUES (?, ?, ?)",
+            [(band, value, screenshot_id) for band, value in _bands(phash)]
+        )
+    if match is None:
+        return ScreenshotCheck(screenshot_id, order_id)
+    return ScreenshotCheck(screenshot_id, order_id, *match)
+
+
+def known_file(conn, file_unique_id):
+    return conn.execute(
+        "SELECT 1 FROM screenshots WHERE file_unique_id = ? LIMIT 1", (file_unique_id,)
+    ).fetchone() is not None
+
+
+async def download_photo(bot, file_id):
+    file = await bot.get_file(file_id)
+    return bytes(await file.download_as_bytearray())
+
+
+# Проверка скриншотов оплаты: уже известный Telegram файл распознаётся без
+# скачивания, остальные скачиваются (fetch подменяется в тестах) и хешируются
+# в пуле процессов, чтобы не занимать цикл событий.
+class ScreenshotChecker:
+    def __init__(self, database, fetch=download_photo, max_distance=MAX_DISTANCE, workers=HASH_WORKERS):
+        self.db = database
+        self.fetch = fetch
+        self.max_distance = max_distance
+        self.workers = workers
+        self.checked = 0
+        self.duplicates = 0
+        self._pool = None
+
+    def _executor(self):
+        # Демонические процессы (воркеры cluster.py) не могут порождать
+        # дочерние, там хеш считается в потоке по умолчанию
+        if self._pool is None and not multiprocessing.current_process().daemon:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def check(self, bot, user_id, photo):
+        phash = detail = None
+        if not await self.db.read(lambda conn: known_file(conn, photo.file_unique_id)):
+            data = await self.fetch(bot, photo.file_id)
+            phash, detail = await asyncio.get_running_loop().run_in_executor(self._executor(), fingerprint, data)
+        result = await self.db.write(
+            lambda conn: register(conn, user_id, photo.file_unique_id, phash, detail, self.max_distance)
+        )
+        self.checked += 1
+        if result.duplicate_of is not None:
+            self.duplicates += 1
+            logger.warning(f"Screenshot {result.screenshot_id} from {user_id} resembles {result.duplicate_of} "
+                           f"(distance {result.distance})")
+        return result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -0,0 +1,69 @@
+from datetime import date
+
+# Агрегаты продаж обновляются триггером в той же транзакции, что и вставка
+# заказа (сумма покупок пользователя — ещё и при смене статуса на
+# выполненный); здесь только чтение и полный пересчёт. Перенос в архив агрегаты
+# не меняет, поэтому пересчёт учитывает и архивные заказы.
+ORDER_COLUMNS = "user_id, uc_amount, amount_kop, status, created_at"
+LIVE_ORDERS = f"(SELECT {ORDER_COLUMNS} FROM main.orders)"
+ALL_ORDERS = f"(SELECT {ORDER_COLUMNS} FROM main.orders UNION ALL SELECT {ORDER_COLUMNS} FROM archive.orders)"
+REBUILD_SQL = {
+    'sales_totals':
+        "INSERT INTO sales_totals (id, orders_count, revenue_kop) "
+        "SELECT 1, COUNT(*), COALESCE(SUM(amount_kop), 0) FROM {orders}",
+    'sales_by_package':
+        "INSERT INTO sales_by_package (uc_amount, orders_count, revenue_kop) "
+        "SELECT uc_amount, COUNT(*), SUM(amount_kop) FROM {orders} GROUP BY uc_amount",
+    'sales_by_day':
+        "INSERT INTO sales_by_day (day, orders_count, revenue_kop) "
+        "SELECT date(created_at, 'unixepoch', 'localtime'), COUNT(*), SUM(amount_kop) FROM {orders} "
+        "GROUP BY date(created_at, 'unixepoch', 'localtime')",
+    'user_order_stats':
+        "INSERT INTO user_order_stats (user_id, orders_count, spent_kop) "
+        "SELECT user_id, COUNT(*), SUM(CASE WHEN status = 'completed' THEN amount_kop ELSE 0 END) "
+        "FROM {orders} GROUP BY user_id",
+}
+AGGREGATE_TABLES = tuple(REBUILD_SQL)
+
+
+# Таблица архива создаётся миграцией 14, а пересчёт вызывают и более
+# ранние миграции, когда её ещё нет
+def _orders_source(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'orders'"
+    ).fetchone()
+    return ALL_ORDERS if exists else LIVE_ORDERS
+
+
+def rebuild_aggregates(conn, tables=AGGREGATE_TABLES):
+    source = _orders_source(conn)
+    for table in tables:
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(REBUILD_SQL[table].format(orders=source))
+    row = conn.execute("SELECT orders_count FROM sales_totals WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def read_stats(conn):
+    c = conn.cursor()
+    totals = c.execute("SELECT orders_count, revenue_kop FROM sales_totals WHERE id = 1").fetchone() or (0, 0)
+    popular = c.execute(
+        "SELECT uc_amount, orders_count FROM sales_by_package ORDER BY orders_count DESC LIMIT 1"
+    ).fetchone()
+    today = c.execute(
+        "SELECT orders_count, revenue_kop FROM sales_by_day WHERE day = ?", (date.today().isoformat(),)
+    ).fetchone() or (0, 0)
+    return {
+        'count': totals[0],
+        'revenue_kop': totals[1],
+        'popular': popular,
+        'today_count': today[0],
+        'today_revenue_kop': today[1],
+    }
+
+
+def read_user_summary(conn, user_id):
+    row = conn.execute(
+        "SELECT orders_count, spent_kop FROM user_order_stats WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return row or (0, 0)